@@ -55,6 +55,7 @@ var _devices_by_list_entry = {}
 var _devices_list = []
 
 var functions_blendshapes = preload("MediaPipeController_BlendShapes.gd")
+var functions_tracking_packet = preload("MediaPipeController_TrackingPacket.gd")
 
 # FIXME: Make key for this configurable.
 var tracking_pause = false
@@ -68,6 +69,54 @@ var min_hand_detection_confidence = 0.75
 var min_hand_tracking_confidence = 0.75
 var min_hand_presence_confidence = 0.9
 
+## How many times per second to run face and hand tracking on the camera
+## frames. Zero means every frame.
+var face_tracking_rate : float = 0.0
+var hand_tracking_rate : float = 0.0
+
+## Run the face and hand landmarkers in their own processes, so they
+## can use separate CPU cores.
+var use_worker_processes : bool = false
+
+## Skip face and hand tracking on frames where almost nothing changed,
+## and reuse the last results instead. This is the average difference
+## per pixel (0-255) needed to count as movement. Zero turns it off.
+var motion_gate_threshold : float = 0.0
+## Longest time (in seconds) to go without tracking a frame, even if
+## nothing is moving.
+var motion_gate_max_skip_time : float = 0.5
+
+## Video file (or directory of images) to track instead of the camera.
+## Leave empty to use the camera.
+var video_source_path : String = ""
+## Play recordings back at their original speed, instead of as fast as
+## possible.
+var video_source_real_time : bool = true
+
+## File to record raw tracking results to, for reproducing tracking
+## problems later. Leave empty to not record.
+var result_recording_path : String = ""
+
+## How often (in seconds) the tracker sends timing stats for each stage
+## of its pipeline. Zero turns it off. The latest ones end up in
+## tracker_latency_stats.
+var latency_stats_interval : float = 0.0
+var tracker_latency_stats : Dictionary = {}
+
+## Ask the tracker for compact binary tracking packets instead of JSON.
+## Trackers that don't know about them just keep sending JSON, which we can
+## still read.
+var use_binary_tracking_packets : bool = true
+## Also quantize binary tracking packets to 16 bits per value, and only send
+## what changed between keyframes. Smaller, but slightly less precise (see
+## "quantization_error" in tracker_latency_stats).
+var quantize_tracking_packets : bool = false
+
+## Get tracking data from the tracker through a memory-mapped file instead of
+## UDP. We only ever see the newest packet this way, so there's no backlog of
+## old ones to get through. Status and errors still come over UDP.
+var use_shared_memory_transport : bool = false
+
 var hand_rotation_smoothing : float = 2.0
 var hand_position_smoothing : float = 4.0
 
@@ -82,6 +131,50 @@ var last_packet_received = null
 # What we should show in the new error/warning reporting.
 var _current_error_to_show : String = ""
 
+# Packet sequence and age tracking, so we can see latency and loss from
+# the tracker. Ages are in seconds, from when the camera captured the
+# frame to when we got the packet. Reset every time the tracker starts.
+# Through shared memory, a newer packet just replaces one we haven't read yet,
+# so gaps there count as superseded instead of lost.
+var _last_packet_sequence : int = -1
+var packets_received : int = 0
+var packets_lost : int = 0
+var packets_superseded : int = 0
+var packets_out_of_order : int = 0
+var packet_age : float = 0.0
+var packet_age_average : float = 0.0
+var packet_age_max : float = 0.0
+var face_result_age : float = 0.0
+var hands_result_age : float = 0.0
+
+# Blendshape names, in the order the tracker sends their values. The tracker
+# sends these whenever they change (and every so often, in case one gets
+# lost). Packets with values for some other schema get their blendshapes
+# ignored until the right names show up.
+var _blendshape_schema_id : int = -1
+var _blendshape_names : Array = []
+
+# Name-to-value dictionary for the current schema. Built once when the schema
+# shows up, then only its values get updated for each packet.
+var _blendshapes : Dictionary = {}
+
+# Decoder state for quantized binary packets.
+var _tracking_packet_state : Dictionary = {}
+
+# Shared memory file the tracker writes packets into (see
+# _tracker/Project/shared_memory_transport.py), and the sequence counter
+# from the last packet we read out of it. The file stays open, and is only
+# looked for once in a while until it shows up.
+const SHARED_MEMORY_MAGIC : int = 0x4D48534B # "KSHM", as a little-endian uint32
+const SHARED_MEMORY_VERSION : int = 1
+const SHARED_MEMORY_HEADER_SIZE : int = 24
+const SHARED_MEMORY_CHECKSUM_SIZE : int = 4
+const SHARED_MEMORY_OPEN_RETRY_MSEC : int = 1000
+var _shared_memory_file : FileAccess = null
+var _shared_memory_file_size : int = 0
+var _shared_memory_next_open_time : int = 0
+var _shared_memory_last_sequence : int = 0
+
 #region Standard Interface Implementation
 
 func _ready():
@@ -150,6 +243,49 @@ func _ready():
 		"advanced"
 	)
 
+	add_tracked_setting(
+		"face_tracking_rate", "Face tracking rate (per second, 0 = every frame)",
+		{ "min" : 0.0, "max" : 120.0, "step" : 1.0 },
+		"advanced")
+	add_tracked_setting(
+		"hand_tracking_rate", "Hand tracking rate (per second, 0 = every frame)",
+		{ "min" : 0.0, "max" : 120.0, "step" : 1.0 },
+		"advanced")
+	add_tracked_setting(
+		"use_worker_processes", "Run landmarkers in separate processes", {},
+		"advanced")
+	add_tracked_setting(
+		"motion_gate_threshold", "Motion needed to track a frame (0 = always track)",
+		{ "min" : 0.0, "max" : 32.0, "step" : 0.1 },
+		"advanced")
+	add_tracked_setting(
+		"motion_gate_max_skip_time", "Longest time without tracking a frame (seconds)",
+		{ "min" : 0.0, "max" : 5.0, "step" : 0.05 },
+		"advanced")
+	add_tracked_setting(
+		"video_source_path", "Track a recording instead of the camera",
+		{"is_fileaccess": true, "file_filters": PackedStringArray(["*.mp4,*.mkv,*.webm,*.avi,*.mov;Video Files"])},
+		"advanced")
+	add_tracked_setting(
+		"video_source_real_time", "Play recordings at normal speed", {},
+		"advanced")
+	add_tracked_setting(
+		"result_recording_path", "Record tracking results to file", {},
+		"advanced")
+	add_tracked_setting(
+		"latency_stats_interval", "Send latency stats every (seconds, 0 = never)",
+		{ "min" : 0.0, "max" : 60.0, "step" : 1.0 },
+		"advanced")
+	add_tracked_setting(
+		"use_binary_tracking_packets", "Use binary tracking packets", {},
+		"advanced")
+	add_tracked_setting(
+		"quantize_tracking_packets", "Quantize binary tracking packets", {},
+		"advanced")
+	add_tracked_setting(
+		"use_shared_memory_transport", "Get tracking data through shared memory", {},
+		"advanced")
+
 	add_tracked_setting(
 		"frames_missing_before_spine_reset", "Untracked frames before reset",
 		{ "min" : -1.0, "max" : 120.0, "step" : 1.0 },
@@ -323,6 +459,10 @@ func scene_shutdown():
 	udp_server.close()
 	udp_server = null
 
+	_close_shared_memory()
+	if FileAccess.file_exists(_get_shared_memory_path()):
+		DirAccess.remove_absolute(_get_shared_memory_path())
+
 	var root = get_skeleton().get_parent()
 	var left_rest = root.get_node("LeftHandRestReference")
 	var right_rest = root.get_node("RightHandRestReference")
@@ -416,6 +556,7 @@ func _get_video_device_index():
 	return -1
 
 func _start_tracker():
+	_reset_packet_stats()
 	tracker_python_process.call_rpc_async(
 		"start_tracker", [])
 
@@ -448,12 +589,118 @@ func _send_settings_to_tracker():
 			"hand_detection_confidence": min_hand_detection_confidence,
 			"hand_tracking_confidence": min_hand_tracking_confidence,
 			"hand_presence_confidence": min_hand_presence_confidence,
+			"face_tracking_rate" : face_tracking_rate,
+			"hand_tracking_rate" : hand_tracking_rate,
+			"use_worker_processes" : use_worker_processes,
+			"motion_gate_threshold" : motion_gate_threshold,
+			"motion_gate_max_skip_time" : motion_gate_max_skip_time,
+			"video_source_path" : video_source_path,
+			"video_source_real_time" : video_source_real_time,
+			"result_recording_path" : result_recording_path,
+			"latency_stats_interval" : latency_stats_interval,
+			"packet_format" : _get_packet_format(),
+			"shared_memory_path" : _get_shared_memory_path() if use_shared_memory_transport else "",
 		}])
 
+func _get_shared_memory_path() -> String:
+	return ProjectSettings.globalize_path(
+		get_app().get_cache_location().path_join(
+			"MediaPipeTracking_%d.shm" % OS.get_process_id()))
+
+func _get_packet_format() -> String:
+	if not use_binary_tracking_packets:
+		return "json"
+	if quantize_tracking_packets:
+		return "binary_quantized"
+	return "binary"
+
 #endregion
 
 #region Update Code
 
+func _reset_packet_stats():
+	_last_packet_sequence = -1
+	packets_received = 0
+	packets_lost = 0
+	packets_superseded = 0
+	packets_out_of_order = 0
+	packet_age = 0.0
+	packet_age_average = 0.0
+	packet_age_max = 0.0
+	_blendshape_schema_id = -1
+	_blendshape_names = []
+	_blendshapes = {}
+	_tracking_packet_state = {}
+	_close_shared_memory()
+	face_result_age = 0.0
+	hands_result_age = 0.0
+
+# Update sequence and age stats for a tracking packet. Returns false if the
+# packet is older than one we've already used, and should be dropped.
+func _update_packet_stats(parsed_data : Dictionary) -> bool:
+
+	# Older trackers don't send any of this.
+	if not parsed_data.has("sequence"):
+		return true
+
+	var sequence : int = int(parsed_data["sequence"])
+
+	if _last_packet_sequence != -1:
+		if sequence <= _last_packet_sequence:
+			# A big jump backwards means the tracker restarted without us
+			# knowing. Anything else is just late.
+			if _last_packet_sequence - sequence < 1000:
+				packets_out_of_order += 1
+				return false
+		elif use_shared_memory_transport:
+			packets_superseded += sequence - _last_packet_sequence - 1
+		else:
+			packets_lost += sequence - _last_packet_sequence - 1
+
+	_last_packet_sequence = sequence
+	packets_received += 1
+
+	var now : float = Time.get_unix_time_from_system()
+	packet_age = now - float(parsed_data["capture_time"])
+	face_result_age = now - float(parsed_data["face_result_time"])
+	hands_result_age = now - float(parsed_data["hands_result_time"])
+	if packets_received == 1:
+		packet_age_average = packet_age
+	else:
+		packet_age_average = lerp(packet_age_average, packet_age, 0.05)
+	packet_age_max = max(packet_age_max, packet_age)
+
+	return true
+
+## Turn the blendshape values in a tracker packet back into a "blendshapes"
+## dictionary of names to values, using the latest schema.
+##
+## The same dictionary gets handed out for every packet, with new values, so
+## don't hang on to it expecting it to stay the same.
+func _expand_blendshapes(parsed_data : Dictionary):
+
+	if parsed_data.has("blendshape_schema"):
+		var schema : Dictionary = parsed_data["blendshape_schema"]
+		# The tracker re-sends the schema every so often even when it hasn't
+		# changed. Only rebuild the dictionary if it actually did.
+		if int(schema["id"]) != _blendshape_schema_id or schema["names"] != _blendshape_names:
+			_blendshape_schema_id = int(schema["id"])
+			_blendshape_names = schema["names"]
+			_blendshapes = {}
+			for shape_name in _blendshape_names:
+				_blendshapes[shape_name] = 0.0
+
+	if not parsed_data.has("blendshape_values"):
+		return
+
+	if int(parsed_data["blendshape_schema_id"]) != _blendshape_schema_id:
+		return
+
+	var values : Array = parsed_data["blendshape_values"]
+	for index in range(min(len(values), len(_blendshape_names))):
+		_blendshapes[_blendshape_names[index]] = values[index]
+	parsed_data["blendshapes"] = _blendshapes
+
 static func _mirror_parsed_data(parsed_data : Dictionary) -> Dictionary:
 
 	var new_parsed_data : Dictionary = parsed_data.duplicate(true)
@@ -534,9 +781,27 @@ func _process_single_packet(delta : float, parsed_data : Dictionary):
 		set_status(_current_error_to_show)
 		return
 
-	set_status("Receiving tracker data")
+	if "latency_stats" in parsed_data:
+		tracker_latency_stats = parsed_data["latency_stats"]
+		return
+
+	if not _update_packet_stats(parsed_data):
+		return
+
+	if parsed_data.has("sequence") and use_shared_memory_transport:
+		set_status("Receiving tracker data (age: %d ms avg, %d ms max. Superseded: %d)" % [
+			int(packet_age_average * 1000.0), int(packet_age_max * 1000.0),
+			packets_superseded])
+	elif parsed_data.has("sequence"):
+		set_status("Receiving tracker data (age: %d ms avg, %d ms max. Lost: %d. Out of order: %d)" % [
+			int(packet_age_average * 1000.0), int(packet_age_max * 1000.0),
+			packets_lost, packets_out_of_order])
+	else:
+		set_status("Receiving tracker data")
 
 	# -----------------
+	_expand_blendshapes(parsed_data)
+
 	if mirror_mode:
 		parsed_data = _mirror_parsed_data(parsed_data)
 
@@ -586,6 +851,93 @@ func _process_single_packet(delta : float, parsed_data : Dictionary):
 
 	_current_error_to_show = ""
 
+func _close_shared_memory():
+	_shared_memory_file = null
+	_shared_memory_file_size = 0
+	_shared_memory_next_open_time = 0
+	_shared_memory_last_sequence = 0
+
+func _open_shared_memory() -> bool:
+
+	# Don't go looking for the file every frame while the tracker is still
+	# starting up.
+	var now : int = Time.get_ticks_msec()
+	if now < _shared_memory_next_open_time:
+		return false
+	_shared_memory_next_open_time = now + SHARED_MEMORY_OPEN_RETRY_MSEC
+
+	var path : String = _get_shared_memory_path()
+	if not FileAccess.file_exists(path):
+		return false
+	_shared_memory_file = FileAccess.open(path, FileAccess.READ)
+	if not _shared_memory_file:
+		return false
+
+	# The tracker never resizes the file after creating it, so we only need
+	# to check this once. (It might not have been sized yet, though.)
+	_shared_memory_file_size = _shared_memory_file.get_length()
+	if _shared_memory_file_size <= SHARED_MEMORY_HEADER_SIZE:
+		_shared_memory_file = null
+		return false
+
+	return true
+
+## Get the newest packet out of shared memory, if there's a new one. Returns
+## an empty array if there isn't (or if the tracker was in the middle of
+## writing one every time we looked).
+func _read_shared_memory_packet() -> PackedByteArray:
+
+	if not use_shared_memory_transport:
+		if _shared_memory_file:
+			_close_shared_memory()
+		return PackedByteArray()
+
+	if not _shared_memory_file:
+		if not _open_shared_memory():
+			return PackedByteArray()
+
+	# The whole file (header and packet) gets read in one go, so the header
+	# and packet come from as close to the same moment as we can get. The
+	# sequence counter is odd while the tracker is writing. The tracker could
+	# still have been partway through a packet while we were reading, and on
+	# CPUs that don't keep stores in order (ARM) we could even see the new
+	# counter before the new packet, so the checksum has to match too.
+	for attempt in range(8):
+		_shared_memory_file.seek(0)
+		var contents : PackedByteArray = _shared_memory_file.get_buffer(_shared_memory_file_size)
+		if len(contents) < SHARED_MEMORY_HEADER_SIZE:
+			return PackedByteArray()
+		if contents.decode_u32(0) != SHARED_MEMORY_MAGIC or contents.decode_u32(4) != SHARED_MEMORY_VERSION:
+			return PackedByteArray()
+
+		var sequence : int = contents.decode_u64(8)
+		if sequence & 1:
+			continue
+		if sequence == _shared_memory_last_sequence:
+			return PackedByteArray()
+
+		var packet_end : int = SHARED_MEMORY_HEADER_SIZE + contents.decode_u32(16)
+		if packet_end > len(contents):
+			continue
+		var packet : PackedByteArray = contents.slice(SHARED_MEMORY_HEADER_SIZE, packet_end)
+
+		var hashing_context : HashingContext = HashingContext.new()
+		hashing_context.start(HashingContext.HASH_MD5)
+		hashing_context.update(packet)
+		var checksum : PackedByteArray = hashing_context.finish().slice(0, SHARED_MEMORY_CHECKSUM_SIZE)
+		if checksum == contents.slice(20, 20 + SHARED_MEMORY_CHECKSUM_SIZE):
+			_shared_memory_last_sequence = sequence
+			return packet
+
+	return PackedByteArray()
+
+func _parse_packet(packet : PackedByteArray):
+	if functions_tracking_packet.is_binary_packet(packet):
+		return functions_tracking_packet.decode(packet, _tracking_packet_state)
+	var json = JSON.new()
+	json.parse(packet.get_string_from_utf8())
+	return json.data
+
 func _process_new_packets(delta):
 	var most_recent_packet = null
 	var dropped_packets = 0
@@ -596,10 +948,7 @@ func _process_new_packets(delta):
 		# FIXME: Disallow packets from remote systems, unless allowed
 		# explicitly.
 
-		var packet_string = packet.get_string_from_utf8()
-		var json = JSON.new()
-		json.parse(packet_string)
-		var parsed_data = json.data
+		var parsed_data = _parse_packet(packet)
 
 		if parsed_data:
 			last_packet_received = parsed_data.duplicate(true)
@@ -618,6 +967,14 @@ func _process_new_packets(delta):
 		else:
 			print_log(["Dropped packets (WARNING): ", dropped_packets])
 
+	# Tracking data from shared memory, if we're using that.
+	var shared_memory_packet : PackedByteArray = _read_shared_memory_packet()
+	if len(shared_memory_packet) > 0:
+		var parsed_data = _parse_packet(shared_memory_packet)
+		if parsed_data:
+			last_packet_received = parsed_data.duplicate(true)
+			_process_single_packet(delta, parsed_data)
+
 	# Write blendshapes (even if we didn't get any packets).
 	var blend_shapes_to_apply : Dictionary = get_global_mod_data("BlendShapes")
 	blend_shapes_to_apply.clear()
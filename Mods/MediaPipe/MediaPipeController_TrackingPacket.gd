@@ -0,0 +1,223 @@
+extends Object
+
+# Decoder for the binary tracking packets from the tracker. See
+# _tracker/Project/tracking_packet.py for the layout. Keep the two in sync.
+
+const PACKET_MAGIC : int = 0x4B52544B # "KTRK", as a little-endian uint32
+const PACKET_VERSION : int = 2
+
+const FLAG_BLENDSHAPE_SCHEMA : int = 1
+const FLAG_QUANTIZED : int = 2
+const FLAG_KEYFRAME : int = 4
+
+const HEADER_SIZE : int = 48
+const COUNTS_SIZE : int = 6
+const POSE_VALUE_COUNT : int = 7 + 13 + 13
+
+# Ranges for quantized values, as [ low, high ].
+const HEAD_ORIGIN_RANGE : Array = [ -8.0, 8.0 ]
+const HAND_ORIGIN_RANGE : Array = [ -16.0, 16.0 ]
+const ROTATION_RANGE : Array = [ -1.0, 1.0 ]
+const QUAT_RANGE : Array = [ -2.0, 2.0 ]
+const SCORE_RANGE : Array = [ 0.0, 1.0 ]
+const LANDMARK_RANGE : Array = [ -0.5, 0.5 ]
+const BLENDSHAPE_RANGE : Array = [ 0.0, 1.0 ]
+
+## True if the packet looks like a binary tracking packet (as opposed to
+## JSON).
+static func is_binary_packet(packet : PackedByteArray) -> bool:
+	return len(packet) >= 4 and packet.decode_u32(0) == PACKET_MAGIC
+
+static func _get_value_ranges(
+	left_landmark_count : int, right_landmark_count : int,
+	blendshape_count : int) -> Array:
+
+	var ranges : Array = []
+	for index in range(3):
+		ranges.append(HEAD_ORIGIN_RANGE)
+	for index in range(4):
+		ranges.append(QUAT_RANGE)
+	for hand_index in range(2):
+		for index in range(3):
+			ranges.append(HAND_ORIGIN_RANGE)
+		for index in range(9):
+			ranges.append(ROTATION_RANGE)
+		ranges.append(SCORE_RANGE)
+	for index in range((left_landmark_count + right_landmark_count) * 3):
+		ranges.append(LANDMARK_RANGE)
+	for index in range(blendshape_count):
+		ranges.append(BLENDSHAPE_RANGE)
+	return ranges
+
+## Read the values out of a quantized packet, using (and updating) the
+## decoder state. Returns an empty array if this is a delta packet that we
+## don't have the reference for.
+static func _decode_quantized_values(
+	packet : PackedByteArray, offset : int, flags : int, sequence : int,
+	layout : Array, value_count : int, state : Dictionary) -> PackedFloat64Array:
+
+	var reference_sequence : int = packet.decode_u32(offset)
+	offset += 4
+
+	if state.get("layout", []) != layout:
+		state["layout"] = layout
+		state["ranges"] = _get_value_ranges(layout[0], layout[1], layout[2])
+		state.erase("quantized")
+
+	var quantized : PackedInt32Array
+
+	if flags & FLAG_KEYFRAME:
+		if len(packet) < offset + value_count * 2:
+			return PackedFloat64Array()
+		quantized.resize(value_count)
+		for index in range(value_count):
+			quantized[index] = packet.decode_u16(offset + index * 2)
+
+	else:
+		# Missed something. Wait for the next keyframe.
+		if not state.has("quantized") or state["sequence"] != reference_sequence:
+			return PackedFloat64Array()
+
+		quantized = state["quantized"].duplicate()
+		var mask_offset : int = offset
+		var delta_offset : int = offset + (value_count + 7) / 8
+		for index in range(value_count):
+			if packet[mask_offset + (index >> 3)] & (1 << (index & 7)):
+				if len(packet) < delta_offset + 2:
+					return PackedFloat64Array()
+				quantized[index] = (quantized[index] + packet.decode_s16(delta_offset)) & 0xffff
+				delta_offset += 2
+
+	state["quantized"] = quantized
+	state["sequence"] = sequence
+
+	var ranges : Array = state["ranges"]
+	var values : PackedFloat64Array
+	values.resize(value_count)
+	for index in range(value_count):
+		var value_range : Array = ranges[index]
+		values[index] = value_range[0] + quantized[index] * (value_range[1] - value_range[0]) / 65535.0
+	return values
+
+## Size of the quantized values section, so we can find what comes after
+## it.
+static func _get_quantized_size(
+	packet : PackedByteArray, offset : int, flags : int, value_count : int) -> int:
+
+	if flags & FLAG_KEYFRAME:
+		return 4 + value_count * 2
+
+	var mask_size : int = (value_count + 7) / 8
+	var changed_count : int = 0
+	for mask_index in range(mask_size):
+		var mask_byte : int = packet[offset + 4 + mask_index]
+		while mask_byte:
+			changed_count += mask_byte & 1
+			mask_byte >>= 1
+	return 4 + mask_size + changed_count * 2
+
+## Turn a binary tracking packet into the same Dictionary that the JSON
+## version would have parsed into. state holds what we need to decode delta
+## packets, and should start out as an empty Dictionary. Returns an empty
+## Dictionary if the packet is truncated, from a version we don't know, or
+## a delta from a packet we didn't get.
+static func decode(packet : PackedByteArray, state : Dictionary) -> Dictionary:
+
+	var output : Dictionary = {}
+
+	if len(packet) < HEADER_SIZE + COUNTS_SIZE:
+		return output
+	if not is_binary_packet(packet):
+		return output
+	if packet.decode_u16(4) != PACKET_VERSION:
+		return output
+
+	var flags : int = packet.decode_u16(6)
+	var sequence : int = packet.decode_u32(8)
+
+	# Counts
+	var offset : int = HEADER_SIZE
+	var left_landmark_count : int = packet.decode_u8(offset)
+	var right_landmark_count : int = packet.decode_u8(offset + 1)
+	var blendshape_schema_id : int = packet.decode_u16(offset + 2)
+	var blendshape_count : int = packet.decode_u16(offset + 4)
+	offset += COUNTS_SIZE
+
+	var value_count : int = POSE_VALUE_COUNT + \
+		(left_landmark_count + right_landmark_count) * 3 + blendshape_count
+
+	# Values
+	var values : PackedFloat64Array
+	if flags & FLAG_QUANTIZED:
+		if len(packet) < offset + 4 + (value_count + 7) / 8:
+			return output
+		values = _decode_quantized_values(
+			packet, offset, flags, sequence,
+			[ left_landmark_count, right_landmark_count, blendshape_count ],
+			value_count, state)
+		if len(values) == 0:
+			return output
+		offset += _get_quantized_size(packet, offset, flags, value_count)
+	else:
+		if len(packet) < offset + value_count * 4:
+			return output
+		values.resize(value_count)
+		for index in range(value_count):
+			values[index] = packet.decode_float(offset + index * 4)
+		offset += value_count * 4
+
+	# Header
+	output["sequence"] = sequence
+	output["capture_time"] = packet.decode_double(12)
+	output["face_result_time"] = packet.decode_double(20)
+	output["hands_result_time"] = packet.decode_double(28)
+	output["send_time"] = packet.decode_double(36)
+	output["head_missing_time"] = packet.decode_float(44)
+	output["blendshape_schema_id"] = blendshape_schema_id
+
+	# Poses
+	output["head_origin"] = Array(values.slice(0, 3))
+	output["head_quat"] = Array(values.slice(3, 7))
+	var index : int = 7
+	for hand_name in [ "left", "right" ]:
+		output["hand_" + hand_name + "_origin"] = Array(values.slice(index, index + 3))
+		output["hand_" + hand_name + "_rotation"] = [
+			Array(values.slice(index + 3, index + 6)),
+			Array(values.slice(index + 6, index + 9)),
+			Array(values.slice(index + 9, index + 12)) ]
+		output["hand_" + hand_name + "_score"] = values[index + 12]
+		index += 13
+
+	# Landmarks
+	for hand_name_and_count in [ [ "left", left_landmark_count ], [ "right", right_landmark_count ] ]:
+		var landmarks : Array = []
+		landmarks.resize(hand_name_and_count[1])
+		for landmark_index in range(hand_name_and_count[1]):
+			landmarks[landmark_index] = Array(values.slice(index, index + 3))
+			index += 3
+		output["hand_landmarks_" + hand_name_and_count[0]] = landmarks
+
+	output["blendshape_values"] = Array(values.slice(index))
+
+	# Blendshape names, if they're in this one.
+	if flags & FLAG_BLENDSHAPE_SCHEMA:
+		if len(packet) < offset + 2:
+			return {}
+		var name_count : int = packet.decode_u16(offset)
+		offset += 2
+		var names : Array = []
+		for name_index in range(name_count):
+			if len(packet) < offset + 1:
+				return {}
+			var name_length : int = packet.decode_u8(offset)
+			offset += 1
+			if len(packet) < offset + name_length:
+				return {}
+			names.append(packet.slice(offset, offset + name_length).get_string_from_utf8())
+			offset += name_length
+		output["blendshape_schema"] = {
+			"id" : blendshape_schema_id,
+			"names" : names
+		}
+
+	return output
@@ -50,7 +50,7 @@ def xform(matrix, vec):
 
     if vec.size == 3:
         vec_with_w = (vec[0], vec[1], vec[2], 1.0)
-    elif vec_size == 4:
+    elif vec.size == 4:
         vec_with_w = vec
     else:
         assert(0)
@@ -112,7 +112,7 @@ def quaternion_to_euler(q):
     # pitch (y-axis rotation)
     sinp = 2.0 * (q[3] * q[1] - q[2] * q[0])
     if abs(sinp) >= 1.0:
-        yaw = math.copysign(M_PI / 2, sinp) # use 90 degrees if out of range
+        yaw = math.copysign(math.pi / 2, sinp) # use 90 degrees if out of range
     else:
         yaw = math.asin(sinp)
 
@@ -147,6 +147,136 @@ def euler_to_quaternion(e):
 
     return q;
 
+# ----------------------------------------------------------------------
+# Batched versions of the above
+#
+# These take stacks of things ((N,4) quaternions, (N,3,3) matrices,
+# (N,3) vectors or euler angles) and give back stacks of results. The
+# math is the same as the single versions, in the same order, so
+# results should match them to the last bit or two.
+
+def xform_many(matrix, vecs):
+
+    vecs = numpy.asarray(vecs, dtype=numpy.float64)
+
+    if vecs.shape[1] == 3:
+        vecs_with_w = numpy.empty((len(vecs), 4))
+        vecs_with_w[:, 0:3] = vecs
+        vecs_with_w[:, 3] = 1.0
+    elif vecs.shape[1] == 4:
+        vecs_with_w = vecs
+    else:
+        assert(0)
+
+    out = vecs_with_w @ numpy.asarray(matrix).T
+
+    if vecs.shape[1] == 3:
+        out = out[:, 0:3] / out[:, 3:4]
+
+    return out
+
+def quaternions_to_matrices(quats):
+
+    quats = numpy.asarray(quats, dtype=numpy.float64)
+
+    qx = quats[:, 0]
+    qy = quats[:, 1]
+    qz = quats[:, 2]
+    qw = quats[:, 3]
+    qx2 = qx * qx
+    qy2 = qy * qy
+    qz2 = qz * qz
+
+    mats = numpy.empty((len(quats), 3, 3))
+
+    mats[:, 0, 0] = 1.0 - 2.0 * qy2     - 2.0 * qz2
+    mats[:, 0, 1] =       2.0 * qx * qy - 2.0 * qz * qw
+    mats[:, 0, 2] =       2.0 * qx * qz + 2.0 * qy * qw
+
+    mats[:, 1, 0] =       2.0 * qx * qy + 2.0 * qz * qw
+    mats[:, 1, 1] = 1.0 - 2.0 * qx2     - 2.0 * qz2
+    mats[:, 1, 2] =       2.0 * qy * qz - 2.0 * qx * qw
+
+    mats[:, 2, 0] =       2.0 * qx * qz - 2.0 * qy * qw
+    mats[:, 2, 1] =       2.0 * qy * qz + 2.0 * qx * qw
+    mats[:, 2, 2] = 1.0 - 2.0 * qx2     - 2.0 * qy2
+
+    return mats
+
+# Works on (N,4,4) transforms too. Only the rotation part is used.
+def matrices_to_quaternions(mats):
+
+    mats = numpy.asarray(mats, dtype=numpy.float64)
+
+    k = 1.0 - mats[:, 0, 0] + mats[:, 1, 1] + mats[:, 2, 2]
+
+    # Anything that the single version would give up on gets an
+    # identity quaternion.
+    valid = k > 0.0
+
+    quats = numpy.zeros((len(mats), 4))
+    quats[:, 3] = 1.0
+
+    w = numpy.sqrt(k[valid])
+    w4 = 4.0 * w
+    quats[valid, 0] = (mats[valid, 2, 1] - mats[valid, 1, 2]) / w4
+    quats[valid, 1] = (mats[valid, 0, 2] - mats[valid, 2, 0]) / w4
+    quats[valid, 2] = (mats[valid, 1, 0] - mats[valid, 0, 1]) / w4
+    quats[valid, 3] = w
+
+    return quats
+
+# Gives an (N,3) array, in the same order as the tuples from
+# quaternion_to_euler().
+def quaternions_to_eulers(quats):
+
+    q = numpy.asarray(quats, dtype=numpy.float64)
+
+    eulers = numpy.empty((len(q), 3))
+
+    # roll (x-axis rotation)
+    sinr_cosp = 2.0 * (q[:, 3] * q[:, 0] + q[:, 1] * q[:, 2])
+    cosr_cosp = 1.0 - 2.0 * (q[:, 0] * q[:, 0] + q[:, 1] * q[:, 1])
+
+    eulers[:, 0] = numpy.arctan2(sinr_cosp, cosr_cosp)
+
+    # pitch (y-axis rotation)
+    sinp = 2.0 * (q[:, 3] * q[:, 1] - q[:, 2] * q[:, 0])
+    eulers[:, 1] = numpy.where(
+        numpy.abs(sinp) >= 1.0,
+        numpy.copysign(math.pi / 2, sinp), # use 90 degrees if out of range
+        numpy.arcsin(numpy.clip(sinp, -1.0, 1.0)))
+
+    # yaw (z-axis rotation)
+    siny_cosp = 2.0 * (q[:, 3] * q[:, 2] + q[:, 0] * q[:, 1])
+    cosy_cosp = 1.0 - 2.0 * (q[:, 1] * q[:, 1] + q[:, 2] * q[:, 2])
+    eulers[:, 2] = numpy.arctan2(siny_cosp, cosy_cosp)
+
+    return eulers
+
+def eulers_to_quaternions(eulers):
+
+    e = numpy.asarray(eulers, dtype=numpy.float64)
+
+    yaw   = e[:, 2]
+    pitch = e[:, 1]
+    roll  = e[:, 0]
+
+    cy = numpy.cos(yaw * 0.5)
+    sy = numpy.sin(yaw * 0.5)
+    cp = numpy.cos(pitch * 0.5)
+    sp = numpy.sin(pitch * 0.5)
+    cr = numpy.cos(roll * 0.5)
+    sr = numpy.sin(roll * 0.5)
+
+    quats = numpy.empty((len(e), 4))
+    quats[:, 0] = sr * cp * cy - cr * sp * sy
+    quats[:, 1] = cr * sp * cy + sr * cp * sy
+    quats[:, 2] = cr * cp * sy - sr * sp * cy
+    quats[:, 3] = cr * cp * cy + sr * sp * sy
+
+    return quats
+
 
 # ----------------------------------------------------------------------
 # Vector/Matrix/Transform conversions
@@ -190,39 +320,118 @@ def ndc_to_viewspace(v, z_offset):
 def landmark_to_vector(landmark):
     return numpy.array((landmark.x, -landmark.y, -landmark.z))
 
+# Same as landmark_to_vector, but for a whole list of landmarks at
+# once. Gives an (N,3) array.
+def landmarks_to_array(landmarks):
+    points = numpy.array([ (l.x, l.y, l.z) for l in landmarks ], dtype=numpy.float64)
+    points[:, 1:] *= -1.0
+    return points
+
 def landmark_to_vector_old(landmark):
     return numpy.array((landmark.x, landmark.y, landmark.z))
 
-# Figure out a depth value based on the distance between known
-# normalized (clip-space) coordinates of landmarks, compared to what
-# we would expect the average distance between those points to be.
-def guess_depth_from_known_distance(landmarks, landmarks_world, index0, index1, distance):
-
-    left_point_landmark = landmarks[index0]
-    left_point = landmark_to_vector(left_point_landmark)
-
-    right_point_landmark = landmarks[index1]
-    right_point = landmark_to_vector(right_point_landmark)
-
-    left_right_dist_clip = numpy.linalg.norm(
-        numpy.array(
-            (
-                (left_point[0] - right_point[0]) * camera_aspect_ratio,
-                (left_point[1] - right_point[1]),
-                (left_point[2] - right_point[2]) # FIXME: Fudge factor
-            )
-        )
-    )
-
-    scale = left_right_dist_clip / distance
+# Used by get_hand_viewspace_origin(). See here for what the hard-coded
+# point indices correspond to:
+# https://developers.google.com/mediapipe/solutions/vision/hand_landmarker
+#
+# Table of known distances. Format is:
+#
+# [
+#   [ point_index1, point_index2, distance],
+#   ...
+# ]
+#
+# Distance is in meters. Probably some slack in the distance
+# values, because they effectively just become a weighted average
+# scaling value.
+#
 
-    return 1.0 / scale
+# # Old guessed distances.
+#
+# known_distances = \
+#     [ \
+#       # Wrist to tip of thumb.
+#       [  0,  1, 0.025 ],
+#       [  1,  2, 0.020 ],
+#       [  2,  3, 0.020 ],
+#       [  3,  4, 0.020 ],
+#       # Wrist to knuckles.
+#       [  0,  5, 0.089 ],
+#       [  0, 17, 0.076 ],
+#       # Knuckles to other knuckles.
+#       [  5,  9, 0.015 ],
+#       [  9, 13, 0.015 ],
+#       [ 13, 17, 0.015 ],
+#       # Index finger.
+#       [  5,  6, 0.015 ],
+#       [  6,  7, 0.015 ],
+#       [  7,  8, 0.015 ],
+#       # Middle finger.
+#       [  9, 10, 0.015 ],
+#       [ 10, 11, 0.015 ],
+#       [ 11, 12, 0.015 ],
+#       # Ring finger.
+#       [ 13, 14, 0.015 ],
+#       [ 14, 15, 0.015 ],
+#       [ 15, 16, 0.015 ],
+#       # Little finger.
+#       [ 17, 18, 0.012 ],
+#       [ 18, 19, 0.012 ],
+#       [ 19, 20, 0.012 ]
+#     ]
+
+# Values found through experimentation instead.
+_hand_known_distances = numpy.array(
+    [ \
+      [ 0,  1, 0.053861],
+      [ 1,  2, 0.057096],
+      [ 2,  3, 0.048795],
+      [ 3,  4, 0.039851],
+      [ 0,  5, 0.152538],
+      [ 0, 17, 0.138711],
+      [ 5,  9, 0.029368],
+      [ 9, 13, 0.027699],
+      [13, 17, 0.032673]
+
+      # FIXME: These correspond to finger section lengths. They're
+      # commented out because closing my fist causes the depth
+      # tracking to be disrupted. Should we include them, or find
+      # a way to include them?
+
+      # [ 5,  6, 0.066013],
+      # [ 6,  7, 0.039947],
+      # [ 7,  8, 0.034417],
+      # [ 9, 10, 0.071065],
+      # [10, 11, 0.043812],
+      # [11, 12, 0.036768],
+      # [13, 14, 0.066968],
+      # [14, 15, 0.039825],
+      # [15, 16, 0.035111],
+      # [17, 18, 0.049567],
+      # [18, 19, 0.031087],
+      # [19, 20, 0.029160]
+     ])
+
+# FIXME: Hardcoded fudge-factor
+_hand_known_distances[:, 2] *= 0.25
+
+# Split up so we can do every pair at once.
+_hand_known_distance_index0 = _hand_known_distances[:, 0].astype(numpy.intp)
+_hand_known_distance_index1 = _hand_known_distances[:, 1].astype(numpy.intp)
+_hand_known_distance_lengths = _hand_known_distances[:, 2].copy()
+
+# Clip-space X has to be scaled by the aspect ratio to be comparable
+# to Y.
+_clip_distance_scale = numpy.array([camera_aspect_ratio, 1.0, 1.0])
 
 # Attempt to figure out the hand origin in viewspace.
 #
 # hand_to_head_scale is a fudge value so that we can attempt to force
 # the hand and head into the same scale range, roughly.
 #
+# landmarks can be a list of MediaPipe landmarks, or an (N,3) array
+# from landmarks_to_array().
+#
 def get_hand_viewspace_origin(
         landmarks,
         world_landmarks,
@@ -230,114 +439,34 @@ def get_hand_viewspace_origin(
         position_scale=numpy.array([7.0, 7.0, 3.5]),
         position_offset=numpy.array([0.0, -0.14, 0.0])):
 
-    # Determine a fake Z by taking the average of three separate
-    # measurements, to try to get the most accurate (or at least less
-    # noisy) measurement we can.
+    # Determine a fake Z by taking the weighted average of depth
+    # guesses from each known distance, to try to get the most
+    # accurate (or at least less noisy) measurement we can. Every pair
+    # gets done at once.
 
-    # See here for what the hard-coded point indices correspond to:
-    # https://developers.google.com/mediapipe/solutions/vision/hand_landmarker
+    if not isinstance(landmarks, numpy.ndarray):
+        landmarks = landmarks_to_array(landmarks)
 
+    pair_vectors = \
+        landmarks[_hand_known_distance_index0] - \
+        landmarks[_hand_known_distance_index1]
 
-    # Table of known distances. Format is:
-    #
-    # [
-    #   [ point_index1, point_index2, distance],
-    #   ...
-    # ]
-    #
-    # Distance is in meters. Probably some slack in the distance
-    # values, because they effectively just become a weighted average
-    # scaling value.
-    #
+    # Figure out a weighted average based on how much the vector is
+    # facing the camera Z axis. Stuff facing into the camera has less
+    # accurate results, so weight it lower.
+    pair_lengths = numpy.linalg.norm(pair_vectors, axis=1)
+    weights = numpy.clip(
+        1.0 - 2.0 * numpy.abs(pair_vectors[:, 2] / pair_lengths),
+        0.0, 1.0)
 
-    # # Old guessed distances.
-    #
-    # known_distances = \
-    #     [ \
-    #       # Wrist to tip of thumb.
-    #       [  0,  1, 0.025 ],
-    #       [  1,  2, 0.020 ],
-    #       [  2,  3, 0.020 ],
-    #       [  3,  4, 0.020 ],
-    #       # Wrist to knuckles.
-    #       [  0,  5, 0.089 ],
-    #       [  0, 17, 0.076 ],
-    #       # Knuckles to other knuckles.
-    #       [  5,  9, 0.015 ],
-    #       [  9, 13, 0.015 ],
-    #       [ 13, 17, 0.015 ],
-    #       # Index finger.
-    #       [  5,  6, 0.015 ],
-    #       [  6,  7, 0.015 ],
-    #       [  7,  8, 0.015 ],
-    #       # Middle finger.
-    #       [  9, 10, 0.015 ],
-    #       [ 10, 11, 0.015 ],
-    #       [ 11, 12, 0.015 ],
-    #       # Ring finger.
-    #       [ 13, 14, 0.015 ],
-    #       [ 14, 15, 0.015 ],
-    #       [ 15, 16, 0.015 ],
-    #       # Little finger.
-    #       [ 17, 18, 0.012 ],
-    #       [ 18, 19, 0.012 ],
-    #       [ 19, 20, 0.012 ]
-    #     ]
-
-    # Values found through experimentation instead.
-    known_distances = \
-        [ \
-          [ 0,  1, 0.053861],
-          [ 1,  2, 0.057096],
-          [ 2,  3, 0.048795],
-          [ 3,  4, 0.039851],
-          [ 0,  5, 0.152538],
-          [ 0, 17, 0.138711],
-          [ 5,  9, 0.029368],
-          [ 9, 13, 0.027699],
-          [13, 17, 0.032673]
-
-          # FIXME: These correspond to finger section lengths. They're
-          # commented out because closing my fist causes the depth
-          # tracking to be disrupted. Should we include them, or find
-          # a way to include them?
-
-          # [ 5,  6, 0.066013],
-          # [ 6,  7, 0.039947],
-          # [ 7,  8, 0.034417],
-          # [ 9, 10, 0.071065],
-          # [10, 11, 0.043812],
-          # [11, 12, 0.036768],
-          # [13, 14, 0.066968],
-          # [14, 15, 0.039825],
-          # [15, 16, 0.035111],
-          # [17, 18, 0.049567],
-          # [18, 19, 0.031087],
-          # [19, 20, 0.029160]
-         ]
-
-    # FIXME: Hardcoded fudge-factor
-    for d in known_distances:
-        d[2] = d[2] * 0.25
-
-    # Iterate through known distances and add up the weighted average.
-    fake_z_avg = 0.0
-    total_avg_weight = 0.0
-    for d in known_distances:
-        pt0 = landmark_to_vector(landmarks[d[0]])
-        pt1 = landmark_to_vector(landmarks[d[1]])
-
-        # Figure out a weighted average based on how much the vector
-        # is facing the camera Z axis. Stuff facing into the camera
-        # has less accurate results, so weight it lower.
-        normvec = (pt0 - pt1) / numpy.linalg.norm(pt0 - pt1)
-        weight = numpy.clip(1.0 - 2.0 * abs(normvec[2]), 0.0, 1.0)
-
-        # Add to the average.
-        fake_z_avg += guess_depth_from_known_distance(
-            landmarks, world_landmarks,
-            d[0], d[1], d[2] / hand_to_head_scale) * weight
-        total_avg_weight += weight
+    # Clip-space distance compared to the known distance gives us the
+    # depth.
+    clip_lengths = numpy.linalg.norm(
+        pair_vectors * _clip_distance_scale, axis=1)
+    depths = (_hand_known_distance_lengths / hand_to_head_scale) / clip_lengths
+
+    fake_z_avg = numpy.sum(depths * weights)
+    total_avg_weight = numpy.sum(weights)
 
     if abs(total_avg_weight) < 0.000001:
         print("HEY THE THING HAPPENED", total_avg_weight)
@@ -355,7 +484,7 @@ def get_hand_viewspace_origin(
     # viewspace_origin = ndc_to_viewspace(wrist_point_ndc, -fake_z_avg)
 
     viewspace_origin = ndc_to_viewspace(
-        landmark_to_vector(landmarks[0]),
+        landmarks[0],
         -fake_z_avg)
 
     # Apply calibration settings.
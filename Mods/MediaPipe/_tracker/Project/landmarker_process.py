@@ -0,0 +1,367 @@
+#!/usr/bin/python3
+
+# Runs a single MediaPipe landmarker in its own Python process, so the
+# face and hand trackers (and everything else in the tracker process)
+# aren't all fighting over one GIL.
+#
+# Frames are handed over through shared memory. Only the name of the
+# shared memory block, the frame shape and a timestamp go over the
+# pipe. Results come back pickled over the worker's stdout.
+#
+# The worker is started with subprocess instead of multiprocessing,
+# because multiprocessing's "spawn" start method would re-run the RPC
+# wrapper's main script in the child.
+
+import os
+import sys
+import pickle
+import subprocess
+import threading
+import traceback
+
+from multiprocessing import shared_memory
+
+import numpy
+
+class SharedFrameBuffer:
+    """An image array that lives in shared memory, so a worker process
+    can read it without any copying or pickling."""
+
+    def __init__(self, shape, dtype=numpy.uint8):
+        nbytes = int(numpy.prod(shape)) * numpy.dtype(dtype).itemsize
+        self.shared_memory = shared_memory.SharedMemory(
+            create=True, size=max(nbytes, 1))
+        self.name = self.shared_memory.name
+        self.array = numpy.ndarray(
+            shape, dtype=dtype, buffer=self.shared_memory.buf)
+
+    def close(self):
+        # The array has to go first, or the memory can't be released.
+        self.array = None
+        self.shared_memory.close()
+        try:
+            self.shared_memory.unlink()
+        except FileNotFoundError:
+            pass
+
+class LandmarkerProcess:
+    """Stands in for a face or hand landmarker, but does the actual
+    work in a separate process.
+
+    kind is "face" or "hands". options is a dictionary of keyword
+    arguments for the landmarker options (minus the base options,
+    running mode and callback). result_callback gets called from a
+    reader thread the same way MediaPipe's live stream callback would
+    be, except output_image is always None.
+    """
+
+    def __init__(self, kind, model_asset_path, options, result_callback, log_callback=print):
+
+        self._kind = kind
+        self._model_asset_path = model_asset_path
+        self._options = options
+        self._result_callback = result_callback
+        self._log_callback = log_callback
+        self._write_lock = threading.Lock()
+        self._reader_thread = None
+
+        # How many times the worker has died on us and been started
+        # again.
+        self.restart_count = 0
+
+        self._start_process()
+
+    def _start_process(self):
+
+        # Keep the worker from popping up a console window on
+        # Windows.
+        creation_flags = getattr(subprocess, "CREATE_NO_WINDOW", 0)
+
+        self._process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__)],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            creationflags=creation_flags)
+
+        # Set once we stop caring about this worker (see
+        # _retire_process()).
+        self._retired = threading.Event()
+
+        try:
+            self._send(("init", self._kind, self._model_asset_path, self._options))
+        except (OSError, ValueError):
+            # Died before it even read anything. The reply below will
+            # be an EOF.
+            pass
+
+        # Wait for the landmarker to actually load, so that a bad model
+        # path or option fails here, the same way it would in-process.
+        try:
+            reply = pickle.load(self._process.stdout)
+        except EOFError:
+            reply = ("error", "Landmarker process exited during init.")
+        if reply[0] != "ready":
+            self._retire_process()
+            raise RuntimeError(reply[1])
+
+        self._reader_thread = threading.Thread(
+            target=self._reader_thread_func,
+            args=(self._process, self._retired),
+            daemon=True)
+        self._reader_thread.start()
+
+    def _send(self, message):
+        with self._write_lock:
+            pickle.dump(message, self._process.stdin)
+            self._process.stdin.flush()
+
+    def _reader_thread_func(self, process, retired):
+        while True:
+
+            try:
+                message = pickle.load(process.stdout)
+            except EOFError:
+                # Worker went away. If it was on purpose, whoever
+                # retired it is already dealing with it.
+                break
+            except Exception as e:
+                # Can't make any sense of the stream after this.
+                exception_string_generator = traceback.TracebackException.from_exception(e)
+                self._log_callback("".join(exception_string_generator.format()))
+                break
+
+            # Keep reading until the worker's gone, so it never blocks
+            # writing to us, but nobody wants its results anymore.
+            if retired.is_set():
+                continue
+
+            # One bad result shouldn't take the whole reader down with
+            # it.
+            try:
+                if message[0] == "result":
+                    self._result_callback(message[2], None, message[1])
+                elif message[0] == "error":
+                    self._log_callback(message[1])
+            except Exception as e:
+                exception_string_generator = traceback.TracebackException.from_exception(e)
+                self._log_callback("".join(exception_string_generator.format()))
+
+    def _restart_process(self):
+        """Replace a worker that died. Anything it had queued is lost,
+        but the tracker gives up on those frames on its own after a
+        while."""
+
+        self._log_callback(
+            "%s landmarker process exited (code %s). Restarting it." % (
+                self._kind, self._process.poll()))
+
+        # It's dead or not listening anyway.
+        self._retire_process(kill=True)
+
+        self.restart_count += 1
+        self._start_process()
+
+    def detect_async(self, frame, timestamp_ms):
+        """Queue up a frame for the worker. frame is a
+        SharedFrameBuffer.
+
+        If the worker has died, this starts a new one first. Raises
+        RuntimeError if that doesn't work either."""
+
+        message = ("frame", frame.name, frame.array.shape, timestamp_ms)
+
+        if self._process.poll() is not None:
+            self._restart_process()
+
+        try:
+            self._send(message)
+        except (OSError, ValueError):
+            # Died between the check and the send.
+            self._restart_process()
+            self._send(message)
+
+    def forget_buffer(self, frame):
+        """Tell the worker to let go of a SharedFrameBuffer we're about
+        to close."""
+        try:
+            self._send(("forget", frame.name))
+        except (OSError, ValueError):
+            pass
+
+    def _retire_process(self, kill=False):
+        """Stop using the current worker, and leave waiting for it to
+        exit to a background thread. The tracker calls into here with
+        its mutex held, so this can't sit around for seconds waiting
+        on a worker that's finishing a frame (or hung)."""
+
+        self._retired.set()
+
+        if kill:
+            self._process.kill()
+        else:
+            try:
+                self._send(("quit",))
+            except (OSError, ValueError):
+                pass
+
+        threading.Thread(
+            target=self._reap_process,
+            args=(self._process, self._reader_thread),
+            daemon=True).start()
+        self._reader_thread = None
+
+    def _reap_process(self, process, reader_thread):
+
+        try:
+            process.wait(5.0)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+        # The reader thread gets an EOF now that the worker is gone.
+        # Let it get there before pulling stdout out from under it.
+        if reader_thread is not None:
+            reader_thread.join()
+
+        # Closing stdin flushes it, which fails if the worker died.
+        # Take the write lock so nothing's halfway through a send.
+        with self._write_lock:
+            for stream in [ process.stdin, process.stdout ]:
+                try:
+                    stream.close()
+                except OSError:
+                    pass
+
+    def close(self):
+        if self._reader_thread is None:
+            return
+
+        self._retire_process()
+
+# ----------------------------------------------------------------------
+# Worker side
+
+def _attach_shared_memory(name):
+
+    # On POSIX systems, attaching registers the block with this
+    # process's resource tracker, which would then delete it out from
+    # under the tracker process when we exit. It isn't ours to delete.
+    # Python 3.13 lets us just ask it not to.
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+
+    block = shared_memory.SharedMemory(name=name)
+
+    # Older versions have no way to opt out, so unregister it by hand.
+    # (Relies on the private _name, which is the name with the leading
+    # slash the tracker was given.)
+    if os.name == "posix":
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(block._name, "shared_memory")
+
+    return block
+
+def _create_landmarker(kind, model_asset_path, options):
+
+    import mediapipe
+
+    BaseOptions = mediapipe.tasks.BaseOptions
+    VisionRunningMode = mediapipe.tasks.vision.RunningMode
+
+    # Video mode is synchronous, which is all we need here. The
+    # tracker process already limits how many frames we have queued.
+    if kind == "face":
+        landmarker_options = mediapipe.tasks.vision.FaceLandmarkerOptions(
+            base_options = BaseOptions(model_asset_path = model_asset_path),
+            running_mode = VisionRunningMode.VIDEO,
+            **options)
+        return mediapipe.tasks.vision.FaceLandmarker.create_from_options(landmarker_options)
+
+    if kind == "hands":
+        landmarker_options = mediapipe.tasks.vision.HandLandmarkerOptions(
+            base_options = BaseOptions(model_asset_path = model_asset_path),
+            running_mode = VisionRunningMode.VIDEO,
+            **options)
+        return mediapipe.tasks.vision.HandLandmarker.create_from_options(landmarker_options)
+
+    raise ValueError("Unknown landmarker kind: %s" % kind)
+
+def _worker_main():
+
+    import mediapipe
+
+    message_input = sys.stdin.buffer
+    message_output = sys.stdout.buffer
+
+    # Anything else that gets printed would corrupt the result stream.
+    sys.stdout = sys.stderr
+
+    def send(message):
+        pickle.dump(message, message_output)
+        message_output.flush()
+
+    attached_blocks = {}
+    landmarker = None
+    kind = None
+
+    try:
+        while True:
+
+            try:
+                message = pickle.load(message_input)
+            except EOFError:
+                # Tracker process is gone.
+                break
+
+            if message[0] == "init":
+                kind = message[1]
+                landmarker = _create_landmarker(message[1], message[2], message[3])
+                send(("ready",))
+
+            elif message[0] == "frame":
+                name, shape, timestamp_ms = message[1:]
+
+                if name not in attached_blocks:
+                    attached_blocks[name] = _attach_shared_memory(name)
+
+                image = numpy.ndarray(
+                    shape, dtype=numpy.uint8,
+                    buffer=attached_blocks[name].buf)
+                mp_image = mediapipe.Image(
+                    image_format=mediapipe.ImageFormat.SRGB,
+                    data=image)
+                del image
+
+                result = landmarker.detect_for_video(mp_image, timestamp_ms)
+                del mp_image
+
+                # We don't use the face mesh itself, so don't bother
+                # shipping it back.
+                if kind == "face":
+                    result.face_landmarks = []
+
+                send(("result", timestamp_ms, result))
+
+            elif message[0] == "forget":
+                block = attached_blocks.pop(message[1], None)
+                if block:
+                    block.close()
+
+            elif message[0] == "quit":
+                break
+
+    except Exception as e:
+        exception_string_generator = traceback.TracebackException.from_exception(e)
+        try:
+            send(("error", "".join(exception_string_generator.format())))
+        except Exception:
+            pass
+
+    if landmarker:
+        landmarker.close()
+
+    for block in attached_blocks.values():
+        block.close()
+
+if __name__ == "__main__":
+    _worker_main()
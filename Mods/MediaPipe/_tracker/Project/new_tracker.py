@@ -10,6 +10,12 @@ import threading
 import numpy
 
 import kiri_math
+import landmarker_process
+import video_replay
+import result_recording
+import pipeline_stats
+import tracking_packet
+import shared_memory_transport
 # FIXME: Just use kiri_math.lerp everywhere instead of this.
 from kiri_math import lerp
 
@@ -26,6 +32,569 @@ import gc
 
 import traceback
 
+class FrameRingBuffer:
+    """Small preallocated ring of frame slots shared between the
+    capture thread and the tracker thread.
+
+    The capture thread writes into a slot that nobody is reading, and
+    the tracker thread always takes the newest complete frame. Older
+    frames that were never picked up are just dropped, so the camera
+    can run at its own rate without building up a queue of stale
+    frames in front of the landmarkers.
+
+    Slots keep their image buffers between frames, so once the pool
+    has warmed up, capture and color conversion just write into
+    memory we already have.
+
+    In lossless mode (for replaying recordings), nothing gets dropped.
+    Frames come out oldest first, and the writer has to wait for a
+    free slot instead of recycling an unread one.
+    """
+
+    class Slot:
+        """One frame's worth of storage.
+
+        image is the BGR frame from the camera. rgb_image is the
+        converted frame that gets handed to MediaPipe. When the
+        landmarkers run in worker processes, rgb_shared is
+        the SharedFrameBuffer that rgb_image lives in.
+        capture_perf_time is when the frame came off the camera, by
+        pipeline_stats.now(), for measuring latency.
+
+        """
+
+        FREE    = 0
+        WRITING = 1
+        READY   = 2
+        READING = 3
+
+        def __init__(self):
+            self.image = None
+            self.rgb_image = None
+            self.rgb_shared = None
+            self.capture_time = 0.0
+            self.capture_perf_time = 0.0
+            self.state = self.FREE
+
+    def __init__(self, slot_count=3):
+        self._lock = threading.Lock()
+        self._frame_ready_condition = threading.Condition(self._lock)
+        self._slot_freed_condition = threading.Condition(self._lock)
+        self._slots = [self.Slot() for _ in range(slot_count)]
+        self._ready_slots = []
+        self.frames_dropped = 0
+        self.lossless = False
+
+    def begin_write(self, timeout=0.0):
+        """Get a slot for the capture thread to write into.
+
+        If every slot is full, the oldest frame that hasn't been read
+        yet gets recycled (except in lossless mode). Returns None if
+        there's nothing we can write into after waiting up to timeout
+        seconds (everything is being read, or is still being used by
+        MediaPipe).
+
+        """
+        with self._lock:
+
+            while True:
+
+                for slot in self._slots:
+                    if slot.state == slot.FREE:
+                        slot.state = slot.WRITING
+                        return slot
+
+                if len(self._ready_slots) and not self.lossless:
+                    slot = self._ready_slots.pop(0)
+                    slot.state = slot.WRITING
+                    self.frames_dropped += 1
+                    return slot
+
+                if timeout <= 0.0:
+                    return None
+
+                self._slot_freed_condition.wait(timeout)
+                timeout = 0.0
+
+    def finish_write(self, slot, capture_time):
+        """Mark a slot from begin_write() as holding a complete frame."""
+        with self._lock:
+            slot.capture_time = capture_time
+            slot.state = slot.READY
+            self._ready_slots.append(slot)
+            self._frame_ready_condition.notify()
+
+    def cancel_write(self, slot):
+        """Give back a slot from begin_write() without a frame in it."""
+        with self._lock:
+            slot.state = slot.FREE
+            self._slot_freed_condition.notify()
+
+    def take_newest(self, timeout):
+        """Get the newest complete frame, waiting up to timeout seconds.
+
+        Anything older than the returned frame is dropped. Returns None
+        on timeout. The slot must be given back with release().
+
+        In lossless mode, this gets the oldest frame instead, and
+        doesn't drop anything.
+
+        """
+        with self._lock:
+
+            if not len(self._ready_slots):
+                self._frame_ready_condition.wait(timeout)
+                if not len(self._ready_slots):
+                    return None
+
+            if self.lossless:
+                slot = self._ready_slots.pop(0)
+                slot.state = slot.READING
+                return slot
+
+            slot = self._ready_slots.pop()
+            slot.state = slot.READING
+
+            for stale_slot in self._ready_slots:
+                stale_slot.state = stale_slot.FREE
+                self.frames_dropped += 1
+            self._ready_slots.clear()
+            self._slot_freed_condition.notify_all()
+
+            return slot
+
+    def has_ready_frames(self):
+        with self._lock:
+            return len(self._ready_slots) > 0
+
+    def release(self, slot):
+        """Give back a slot from take_newest(). Don't do this until
+        nothing is looking at the slot's buffers anymore."""
+        with self._lock:
+            slot.state = slot.FREE
+            self._slot_freed_condition.notify()
+
+    def get_all_slots(self):
+        return self._slots
+
+    def reset(self):
+        """Put every slot back in the pool. Only safe when nothing is
+        reading or writing."""
+        with self._lock:
+            for slot in self._slots:
+                slot.state = slot.FREE
+            self._ready_slots.clear()
+
+class InFlightWindow:
+    """Keeps track of the frames one landmarker is working on, by the
+    timestamp they were submitted with.
+
+    Only window_size frames are allowed in flight at once. When the
+    window is full, new frames are skipped instead of piling up
+    inside MediaPipe. Also measures how long each frame took from
+    submission to result callback.
+    """
+
+    def __init__(self, window_size=2):
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self.window_size = window_size
+        self.frames_skipped = 0
+        self.frames_expired = 0
+        self.last_latency = 0.0
+        self.average_latency = 0.0
+
+    def try_submit(self, timestamp_ms):
+        """Reserve a spot in the window for a frame. Returns False
+        (and counts it as skipped) if the window is full."""
+        with self._lock:
+            if len(self._in_flight) >= self.window_size:
+                self.frames_skipped += 1
+                return False
+            self._in_flight[timestamp_ms] = pipeline_stats.now()
+            return True
+
+    def cancel(self, timestamp_ms):
+        """Undo try_submit() for a frame that never made it in."""
+        with self._lock:
+            self._in_flight.pop(timestamp_ms, None)
+
+    def complete(self, timestamp_ms):
+        """Called from the result callback. Returns True if the frame
+        was still in flight (it may have expired already)."""
+        with self._lock:
+            submit_time = self._in_flight.pop(timestamp_ms, None)
+            if submit_time is None:
+                return False
+            self.last_latency = pipeline_stats.now() - submit_time
+            self.average_latency = lerp(
+                self.last_latency, self.average_latency, 0.1)
+            return True
+
+    def expire(self, timeout):
+        """Forget about frames that have been in flight longer than
+        timeout seconds, and return their timestamps. Live stream mode
+        can drop frames without ever calling us back."""
+        now = pipeline_stats.now()
+        with self._lock:
+            expired = [
+                timestamp_ms
+                for timestamp_ms, submit_time in self._in_flight.items()
+                if now - submit_time > timeout ]
+            for timestamp_ms in expired:
+                del self._in_flight[timestamp_ms]
+            self.frames_expired += len(expired)
+            return expired
+
+    def get_count(self):
+        with self._lock:
+            return len(self._in_flight)
+
+    def clear(self):
+        with self._lock:
+            self._in_flight.clear()
+
+class ResultCoalescer:
+    """Decides when a tracking packet should go out. Packets are sent
+    when new results come in, not once per captured frame.
+
+    The tracker thread calls expect() for each frame it sends to the
+    landmarkers, with how many results it's waiting on. Result
+    callbacks call result_arrived() once they've updated the tracking
+    state, and anything that never makes it to a result (skipped or
+    expired) calls cancel(). The output thread waits in
+    wait_for_output().
+
+    Once every result for a frame has come in, the packet goes out
+    right away. If the face and hand results for a frame come in close
+    together, they go out in one packet. If only some have arrived,
+    we give the rest up to max_wait seconds before sending what we've
+    got. Nothing gets sent if no new results have come in, so there
+    are no duplicate packets.
+    """
+
+    def __init__(self, max_wait=0.01):
+        self._lock = threading.Lock()
+        self._condition = threading.Condition(self._lock)
+        self._expected = {}
+        self.max_wait = max_wait
+
+        # Results that haven't gone out yet.
+        self._pending = False
+        self._pending_since = 0.0
+        self._pending_timestamp_ms = 0
+        self._pending_complete = False
+
+        self._should_quit = False
+        self.results_coalesced = 0
+
+    def expect(self, timestamp_ms, result_count, capture_perf_time):
+        """capture_perf_time is when the frame was captured, by
+        pipeline_stats.now()."""
+        with self._lock:
+            self._expected[timestamp_ms] = [result_count, capture_perf_time]
+
+    def _finish_one(self, timestamp_ms):
+        # Call with the lock held. Returns True if that was the last
+        # result we were waiting on for this frame.
+        expected = self._expected.get(timestamp_ms)
+        if expected is None:
+            return True
+        expected[0] -= 1
+        if expected[0] > 0:
+            return False
+        return True
+
+    def result_arrived(self, timestamp_ms):
+        with self._lock:
+            if self._pending:
+                self.results_coalesced += 1
+            else:
+                self._pending = True
+                self._pending_since = pipeline_stats.now()
+            self._pending_timestamp_ms = max(self._pending_timestamp_ms, timestamp_ms)
+            if self._finish_one(timestamp_ms):
+                self._pending_complete = True
+            self._condition.notify_all()
+
+    def cancel(self, timestamp_ms):
+        with self._lock:
+            if self._finish_one(timestamp_ms) and \
+               self._pending and timestamp_ms == self._pending_timestamp_ms:
+                self._pending_complete = True
+                self._condition.notify_all()
+
+    def wait_for_output(self, timeout):
+        """Wait until it's time to send a packet. Returns the
+        (capture_time, capture_perf_time) of the newest frame with
+        results in it, or None if we timed out (or are quitting).
+        capture_perf_time is None if we don't know it."""
+
+        with self._lock:
+
+            end_time = pipeline_stats.now() + timeout
+
+            while not self._should_quit:
+
+                now = pipeline_stats.now()
+
+                if self._pending:
+                    if self._pending_complete:
+                        break
+                    wait_time = self._pending_since + self.max_wait - now
+                    if wait_time <= 0.0:
+                        break
+                else:
+                    wait_time = end_time - now
+                    if wait_time <= 0.0:
+                        return None
+
+                self._condition.wait(wait_time)
+
+            if self._should_quit:
+                return None
+
+            timestamp_ms = self._pending_timestamp_ms
+            capture_perf_time = None
+            if timestamp_ms in self._expected:
+                capture_perf_time = self._expected[timestamp_ms][1]
+
+            # Anything at or before this frame is covered by the packet
+            # we're about to send.
+            for old_timestamp_ms in [ t for t in self._expected if t <= timestamp_ms ]:
+                del self._expected[old_timestamp_ms]
+
+            self._pending = False
+            self._pending_complete = False
+
+            return timestamp_ms / 1000.0, capture_perf_time
+
+    def quit(self):
+        with self._lock:
+            self._should_quit = True
+            self._condition.notify_all()
+
+    def clear(self):
+        with self._lock:
+            self._expected.clear()
+            self._pending = False
+            self._pending_complete = False
+            self._pending_timestamp_ms = 0
+            self._should_quit = False
+
+class LandmarkerSchedule:
+    """Decides which frames a landmarker gets to see, so it runs at
+    about rate times per second. A rate of zero (or less) means every
+    frame."""
+
+    def __init__(self, rate=0.0):
+        self.rate = rate
+        self._next_time = 0.0
+
+    def is_due(self, frame_time):
+        """Check whether the frame captured at frame_time should go to
+        this landmarker. Counts it as used if it should."""
+
+        if self.rate <= 0.0:
+            return True
+
+        period = 1.0 / self.rate
+
+        # Give it a little slack so camera timing jitter doesn't make
+        # us miss the frame we wanted and wait for the next one.
+        if frame_time < self._next_time - period * 0.25:
+            return False
+
+        self._next_time += period
+
+        # If we've fallen behind, don't try to catch up.
+        if self._next_time < frame_time:
+            self._next_time = frame_time + period
+
+        return True
+
+class MotionGate:
+    """Cheap check for whether anything has changed since the last
+    frame we actually ran the landmarkers on.
+
+    Frames get shrunk way down and compared against a copy of the last
+    frame that passed. If the average difference per pixel channel
+    (0-255) is under threshold, the frame can be skipped. A frame
+    always passes if max_skip_time seconds have gone by since the last
+    one, so tracking never goes completely stale. A threshold of zero
+    (or less) turns it off.
+    """
+
+    def __init__(self, threshold=0.0, max_skip_time=0.5):
+        self.threshold = threshold
+        self.max_skip_time = max_skip_time
+        self.frames_skipped = 0
+        self.last_difference = 0.0
+        self._small_image = None
+        self._reference_image = None
+        self._last_pass_time = 0.0
+
+    def check(self, image, frame_time):
+        """Returns True if the landmarkers should run on this frame."""
+
+        if self.threshold <= 0.0:
+            return True
+
+        self._small_image = cv2.resize(
+            image, (64, 48), dst=self._small_image,
+            interpolation=cv2.INTER_AREA)
+
+        if self._reference_image is None or \
+           frame_time - self._last_pass_time >= self.max_skip_time:
+            changed = True
+        else:
+            self.last_difference = cv2.norm(
+                self._small_image, self._reference_image,
+                cv2.NORM_L1) / self._small_image.size
+            changed = self.last_difference >= self.threshold
+
+        if not changed:
+            self.frames_skipped += 1
+            return False
+
+        # This frame is the new reference. The old reference buffer
+        # gets reused for the next frame.
+        self._small_image, self._reference_image = \
+            self._reference_image, self._small_image
+        self._last_pass_time = frame_time
+        return True
+
+    def reset(self):
+        self._reference_image = None
+
+class VideoModeLandmarker:
+    """Wraps a landmarker created in VIDEO mode so it can be used like a
+    live stream one. detect_async() processes the frame immediately and
+    calls the result callback before returning.
+
+    This is for replaying recordings, where we want every frame
+    processed, in order, as fast as possible. Live stream mode would
+    drop frames whenever it's busy.
+    """
+
+    def __init__(self, landmarker, result_callback):
+        self._landmarker = landmarker
+        self._result_callback = result_callback
+
+    def detect_async(self, image, timestamp_ms):
+        result = self._landmarker.detect_for_video(image, timestamp_ms)
+        self._result_callback(result, image, timestamp_ms)
+
+    def close(self):
+        self._landmarker.close()
+
+class HandState:
+    """Latest tracking data for one hand.
+
+    Arrays are allocated once and updated in place, so the result
+    callbacks don't build anything new each frame. landmarks always
+    has room for a whole hand, but only the first landmark_count rows
+    are valid (zero until we've actually tracked the hand).
+    """
+
+    __slots__ = [
+        "position",
+        "rotation_matrix",
+        "position_confidence",
+        "position_confidence_time",
+        "landmarks",
+        "landmark_count" ]
+
+    landmark_capacity = 21
+
+    def __init__(self):
+        self.position = numpy.zeros(3)
+        self.rotation_matrix = numpy.identity(3)
+        self.landmarks = numpy.zeros((self.landmark_capacity, 3))
+        self.position_confidence_time = 0.0
+        self.reset()
+
+    def reset(self):
+        self.position[:] = 0.0
+        self.rotation_matrix[:] = numpy.identity(3)
+        self.position_confidence = 0.0
+        self.landmark_count = 0
+
+    def set_landmarks(self, landmarks):
+        count = min(len(landmarks), self.landmark_capacity)
+        self.landmarks[:count] = landmarks[:count]
+        self.landmark_count = count
+
+    def write_output(self, output_data, side):
+        """Fill in this hand's fields in the tracking packet. side is
+        "left" or "right"."""
+        output_data["hand_%s_origin" % side] = self.position.tolist()
+        output_data["hand_%s_rotation" % side] = self.rotation_matrix.tolist()
+        output_data["hand_%s_score" % side] = self.position_confidence
+        output_data["hand_landmarks_%s" % side] = \
+            self.landmarks[:self.landmark_count].tolist()
+
+class HeadState:
+    """Latest tracking data for the head. Like HandState, position and
+    quat are updated in place.
+
+    missing_time is how many frames we've sent to the face landmarker
+    since it last found a face.
+
+    Blendshape scores are kept in blendshape_values, in the same order
+    as the names in blendshape_schema. blendshape_schema is an (id,
+    names) tuple, and only gets replaced (with a new id) when the
+    landmarker gives us a different set of blendshapes. That way the
+    names only have to go to SnekStudio once, instead of in every
+    packet.
+    """
+
+    __slots__ = [
+        "position",
+        "quat",
+        "blendshape_schema",
+        "blendshape_values",
+        "missing_time" ]
+
+    def __init__(self):
+        self.position = numpy.zeros(3)
+        self.quat = numpy.array([0.0, 0.0, 0.0, 1.0])
+
+        # FIXME: Seed with values?
+        self.blendshape_schema = (0, [])
+        self.blendshape_values = []
+
+        self.missing_time = 10.0
+
+    def set_blendshapes(self, shapes):
+        """Store scores from a list of MediaPipe blendshape
+        categories."""
+
+        names = self.blendshape_schema[1]
+
+        if len(shapes) != len(names) or \
+           any(names[index] != shape.category_name
+               for index, shape in enumerate(shapes)):
+
+            # New set of blendshapes. Values go first, so that anything
+            # reading the schema never sees more names than values.
+            self.blendshape_values = [ shape.score for shape in shapes ]
+            self.blendshape_schema = (
+                self.blendshape_schema[0] + 1,
+                [ shape.category_name for shape in shapes ])
+            return
+
+        values = self.blendshape_values
+        for index, shape in enumerate(shapes):
+            values[index] = shape.score
+
+    def write_output(self, output_data):
+        output_data["head_origin"] = self.position.tolist()
+        output_data["head_quat"] = self.quat.tolist()
+        output_data["blendshape_schema_id"] = self.blendshape_schema[0]
+        output_data["blendshape_values"] = self.blendshape_values
+        output_data["head_missing_time"] = self.missing_time
+
 class MediaPipeTracker:
 
     def __init__(self):
@@ -34,12 +603,57 @@ class MediaPipeTracker:
 
         self._tracker_worker_thread = None
 
+        # Camera reads happen on their own thread, so a slow read()
+        # doesn't hold up the landmarkers (or the mutex). Frames get
+        # handed over through this, newest frame wins.
+        self._capture_thread = None
+        self._frame_ring_buffer = FrameRingBuffer(slot_count=8)
+
+        # Tracking packets go out from their own thread, as soon as
+        # new results come in.
+        self._output_thread = None
+        self._result_coalescer = ResultCoalescer()
+
+        # Frames that have been handed to MediaPipe and haven't come
+        # back through the result callbacks yet, by timestamp. Each
+        # entry is [slot, callbacks_remaining]. The buffers in these
+        # slots can't be reused until then.
+        self._frame_holds = {}
+        self._frame_holds_mutex = threading.Lock()
+
         # We need these to avoid deadlocks. If we're queueing frames
         # faster than they can process, we'll hit a deadlock in
-        # MediaPipe.
-        self.frames_queued_face = 0
-        self.frames_queued_hands = 0
-        self.frames_queued_mutex = threading.Lock()
+        # MediaPipe. Frames that don't fit in the window just get
+        # skipped for that landmarker.
+        self._in_flight_face = InFlightWindow(2)
+        self._in_flight_hands = InFlightWindow(2)
+
+        # Frames that haven't come back after this long are assumed to
+        # have been dropped by MediaPipe.
+        self.in_flight_timeout = 1.0
+
+        # How long each stage of the pipeline takes. Optionally sent
+        # to SnekStudio every latency_stats_interval seconds (zero
+        # means never).
+        self._pipeline_stats = pipeline_stats.PipelineStats()
+        self.latency_stats_interval = 0.0
+        self._last_latency_stats_time = 0.0
+
+        # Raw landmarker results get written here as they come in, if
+        # it's set. See result_recording.py.
+        self._result_recorder = None
+        self.result_recording_path = ""
+
+        # How often each landmarker runs, in frames per second. Hand
+        # tracking is the more expensive one, so it's useful to run it
+        # less often than the face. Zero means every frame.
+        self._face_schedule = LandmarkerSchedule(0.0)
+        self._hand_schedule = LandmarkerSchedule(0.0)
+
+        # Skips both landmarkers when the picture isn't changing, and
+        # just re-sends the last results instead. Off by default.
+        self._motion_gate = MotionGate(0.0, 0.5)
+
         self.should_quit_threads = False
 
         # Open the socket immediately so we can start sending error
@@ -54,37 +668,85 @@ class MediaPipeTracker:
         self.video_device_index = -1
         self.video_device_capture = None
 
+        # With no camera, both threads sleep on this until a device
+        # gets opened (or we're shutting down). Shares the big mutex,
+        # because that's what protects video_device_capture.
+        self._video_device_condition = threading.Condition(self.the_big_ugly_mutex)
+
+        # How long to wait before trying to open a device again, if it
+        # failed.
+        self.video_device_retry_time = 1.0
+
+        # A video file or image directory to use instead of the
+        # camera. Empty string means use the camera. Replays run as
+        # fast as possible unless video_source_real_time is set, and
+        # don't drop frames either way. video_source_fps is only used
+        # if the source doesn't have its own frame rate.
+        self.video_source_path = ""
+        self.video_source_real_time = False
+        self.video_source_fps = 30.0
+        self._replay_finished = False
+
+        # Timestamps we feed into MediaPipe have to keep increasing,
+        # but only for each landmarker instance. This gets reset when
+        # they're re-created.
+        self._last_timestamp_used = 0
+
         self.landmarker = None
         # self.landmarker_pose = None
         self.landmarker_hands = None
 
-        last_hand_data_template = {
-            "position" : numpy.array([0.0, 0.0, 0.0]),
-            "rotation_matrix" : numpy.array([[1.0, 0.0, 0.0], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0]]),
-            "rotation_quat" : [0.0, 0.0, 0.0, 1.0],
-            "position_confidence" : 0.0,
-            "position_confidence_time" : 0.0,
-            "landmarks" : []
-        }
+        # Run each landmarker in its own process instead of in this
+        # one. Frames get passed over in shared memory.
+        self.use_worker_processes = False
+        self._landmarkers_in_worker_processes = False
 
-        self.last_hand_data = {
-            "left" : last_hand_data_template.copy(),
-            "right" : last_hand_data_template.copy()
+        self.hand_states = {
+            "left" : HandState(),
+            "right" : HandState()
         }
 
-        # FIXME: Arrange into dictionary.
-        self.last_head_position = numpy.array([0.0, 0.0, 0.0])
-        self.last_head_quat = numpy.array([0.0, 0.0, 0.0, 1.0])
-
-        # FIXME: Seed with values?
-        self.last_blendshapes = {}
-
-        self.time_since_last_face_detection = 10.0
-
-        # These are for more deadlock avoidance, so we can keep track
-        # of how behind the hand tracker is.
-        self._last_hand_result_timestamp = (time.time() * 1000)
-        self._last_hand_detect_timestamp = (time.time() * 1000)
+        self.head_state = HeadState()
+
+        # Guards everything in hand_states and head_state. The result
+        # callbacks update those in place from MediaPipe's threads, and
+        # they can't take the_big_ugly_mutex (it's held while frames
+        # are submitted, and video mode calls them right from
+        # detect_async()). Take this one after the_big_ugly_mutex, if
+        # you need both.
+        self._tracking_state_lock = threading.Lock()
+
+        # Tracking packet contents. The same dictionary gets filled in
+        # and sent every frame.
+        self._output_data = {}
+
+        # Blendshape names go out whenever they change, and again every
+        # blendshape_schema_interval seconds in case that packet got
+        # lost. Packets in between only have the values.
+        self.blendshape_schema_interval = 1.0
+        self._blendshape_schema_id_sent = -1
+        self._blendshape_schema_send_time = 0.0
+
+        # "json", "binary" or "binary_quantized" (see
+        # tracking_packet.py). SnekStudio asks for binary if it knows
+        # how to read it.
+        self.packet_format = "json"
+        self._packet_encoder = tracking_packet.TrackingPacketEncoder()
+
+        # If SnekStudio gives us a shared memory path, tracking packets
+        # get written there instead of being sent over UDP. Status and
+        # error packets still go over UDP.
+        self.shared_memory_path = ""
+        self._shared_memory_writer = None
+
+        # Every tracking packet gets a sequence number, so SnekStudio
+        # can tell when packets get lost or arrive out of order. The
+        # result times are the capture times (in seconds, same as
+        # time.time()) of the frames that the latest face and hand
+        # results came from.
+        self._packet_sequence = 0
+        self._last_face_result_time = 0.0
+        self._last_hands_result_time = 0.0
 
         # Higher = takes longer to establish confidence, but takes
         # longer to start tracking. A bit better at filtering out
@@ -110,18 +772,71 @@ class MediaPipeTracker:
         with self.the_big_ugly_mutex:
             self.video_device_capture = None
 
-    def _open_video_device(self):
+    def _video_source_selected(self):
+        """Check whether there's any camera or recording we should be
+        trying to open. Call with the mutex held."""
+        if self.video_source_path != "":
+            return not self._replay_finished
+        return self.video_device_index != -1
+
+    def _open_replay(self):
+
+        self._write_log("Opening recording: %s" % self.video_source_path)
+
+        # Unpaced replays can get ahead of the wall clock. Don't start
+        # behind the last timestamp we used.
+        start_time = max(time.time(), self._last_timestamp_used / 1000.0 + 1.0)
+
+        replay = video_replay.ReplayCapture(
+            self.video_source_path, start_time,
+            self.video_source_real_time, self.video_source_fps)
+
+        if replay.isOpened():
+            self._write_log("Recording opened")
+            self.video_device_capture = replay
+            self._frame_ring_buffer.lossless = True
+            self._video_device_condition.notify_all()
+        else:
+            # Don't keep trying.
+            self._replay_finished = True
+            error_string = "Failed to open recording: %s" % self.video_source_path
+            self._write_log(error_string)
+            self._send_error_packet(error_string)
+
+    def _finish_replay(self, replay):
 
         with self.the_big_ugly_mutex:
 
-            if self.video_device_index == -1:
-                self.video_device_capture = None
+            # Settings may have switched the source already.
+            if self.video_device_capture is not replay:
                 return
 
+            self.video_device_capture = None
+            self._replay_finished = True
+
+            elapsed_time = time.time() - replay.open_time
+            self._write_log(
+                "Recording finished: %d frames in %.2f seconds (%.1f fps)" % (
+                    replay.frames_read, elapsed_time,
+                    replay.frames_read / max(elapsed_time, 0.001)))
+
+    def _open_video_device(self):
+
+        with self.the_big_ugly_mutex:
+
             # Check to make sure we don't already have the device open.
             if self.video_device_capture != None:
                 return
 
+            if not self._video_source_selected():
+                return
+
+            self._frame_ring_buffer.lossless = False
+
+            if self.video_source_path != "":
+                self._open_replay()
+                return
+
             # Try opening it!
             self._write_log("Opening a video device!")
 
@@ -137,6 +852,7 @@ class MediaPipeTracker:
 
             if self.video_device_capture.isOpened():
                 self._write_log("Video device acquired")
+                self._video_device_condition.notify_all()
             else:
                 self.video_device_capture = None
                 error_string = "Failed to open video device: %s" % str(self.video_device_index)
@@ -160,12 +876,25 @@ class MediaPipeTracker:
         # pose_landmarker_path = os.path.join(asset_path, "pose_landmarker.task")
         hand_landmarker_path = os.path.join(asset_path, "hand_landmarker.task")
 
+        # These are shared between the in-process landmarkers and the
+        # worker process ones.
+        face_options = {
+            "output_face_blendshapes" : True,
+            "output_facial_transformation_matrixes" : True
+        }
+
+        hand_options = {
+            "num_hands" : 2,
+            "min_hand_detection_confidence" : self.hand_detection_confidence,
+            "min_tracking_confidence" : self.hand_tracking_confidence,
+            "min_hand_presence_confidence" : self.hand_presence_confidence
+        }
+
         options = mediapipe.tasks.vision.FaceLandmarkerOptions(
             base_options = BaseOptions(model_asset_path = face_landmarker_path),
             running_mode = VisionRunningMode.LIVE_STREAM,
-            output_face_blendshapes = True,
-            output_facial_transformation_matrixes = True,
-            result_callback = self._handle_result_face)
+            result_callback = self._handle_result_face,
+            **face_options)
 
         # FIXME: Last minute breakages.
         # options_pose = mediapipe.tasks.vision.PoseLandmarkerOptions(
@@ -177,27 +906,95 @@ class MediaPipeTracker:
         options_hands = mediapipe.tasks.vision.HandLandmarkerOptions(
             base_options = BaseOptions(model_asset_path = hand_landmarker_path),
             running_mode = VisionRunningMode.LIVE_STREAM,
-            num_hands = 2,
+            result_callback = self._handle_result_hands,
+            **hand_options)
+
+        self._shutdown_mediapipe()
 
-            min_hand_detection_confidence = self.hand_detection_confidence,
-            min_tracking_confidence = self.hand_tracking_confidence,
-            min_hand_presence_confidence = self.hand_presence_confidence,
+        # Brand new landmarkers don't care what timestamps the old ones
+        # saw.
+        self._last_timestamp_used = 0
 
-            result_callback = self._handle_result_hands)
+        if self.video_source_path != "":
 
-        self._shutdown_mediapipe()
+            self._write_log("Init face landmarker (video mode)...")
+            options = mediapipe.tasks.vision.FaceLandmarkerOptions(
+                base_options = BaseOptions(model_asset_path = face_landmarker_path),
+                running_mode = VisionRunningMode.VIDEO,
+                **face_options)
+            self.landmarker = VideoModeLandmarker(
+                FaceLandmarker.create_from_options(options),
+                self._handle_result_face)
+
+            self._write_log("Init hand landmarker (video mode)...")
+            options_hands = mediapipe.tasks.vision.HandLandmarkerOptions(
+                base_options = BaseOptions(model_asset_path = hand_landmarker_path),
+                running_mode = VisionRunningMode.VIDEO,
+                **hand_options)
+            self.landmarker_hands = VideoModeLandmarker(
+                vision.HandLandmarker.create_from_options(options_hands),
+                self._handle_result_hands)
+
+            self._landmarkers_in_worker_processes = False
 
-        self._write_log("Init face landmarker...")
-        self.landmarker = FaceLandmarker.create_from_options(options)
+        elif self.use_worker_processes:
 
-        # self._write_log("Init pose landmarker...")
-        # self.landmarker_pose = vision.PoseLandmarker.create_from_options(options_pose)
+            self._write_log("Starting face landmarker process...")
+            self.landmarker = landmarker_process.LandmarkerProcess(
+                "face", face_landmarker_path, face_options,
+                self._handle_result_face, self._write_log)
 
-        self._write_log("Init hand landmarker...")
-        self.landmarker_hands = vision.HandLandmarker.create_from_options(options_hands)
+            self._write_log("Starting hand landmarker process...")
+            self.landmarker_hands = landmarker_process.LandmarkerProcess(
+                "hands", hand_landmarker_path, hand_options,
+                self._handle_result_hands, self._write_log)
+
+            self._landmarkers_in_worker_processes = True
+
+        else:
+
+            self._write_log("Init face landmarker...")
+            self.landmarker = FaceLandmarker.create_from_options(options)
+
+            # self._write_log("Init pose landmarker...")
+            # self.landmarker_pose = vision.PoseLandmarker.create_from_options(options_pose)
+
+            self._write_log("Init hand landmarker...")
+            self.landmarker_hands = vision.HandLandmarker.create_from_options(options_hands)
+
+            self._landmarkers_in_worker_processes = False
 
         self._write_log("Init done")
 
+    def _get_shared_rgb_buffer(self, slot):
+        """Make sure a slot's RGB buffer lives in shared memory, and is
+        the right size for its frame."""
+
+        shape = slot.image.shape
+
+        if slot.rgb_shared is not None:
+            if slot.rgb_shared.array.shape == shape:
+                return slot.rgb_shared
+            self._free_shared_rgb_buffer(slot)
+
+        slot.rgb_shared = landmarker_process.SharedFrameBuffer(shape)
+        slot.rgb_image = slot.rgb_shared.array
+        return slot.rgb_shared
+
+    def _free_shared_rgb_buffer(self, slot):
+
+        if slot.rgb_shared is None:
+            return
+
+        for landmarker in [ self.landmarker, self.landmarker_hands ]:
+            if isinstance(landmarker, landmarker_process.LandmarkerProcess):
+                landmarker.forget_buffer(slot.rgb_shared)
+
+        # Nothing can still be looking at the memory when it's closed.
+        slot.rgb_image = None
+        slot.rgb_shared.close()
+        slot.rgb_shared = None
+
     def _write_log(self, *args):
         try:
             print(*args)
@@ -225,28 +1022,111 @@ class MediaPipeTracker:
         output_data_json = json.dumps(output_data, indent=4).encode("utf-8")
         self._udp_socket.sendto(output_data_json, ("127.0.0.1", self.udp_port_number))
 
+    def _hold_frame(self, slot, timestamp_ms, callback_count):
+        """Keep a frame slot out of the pool until callback_count
+        result callbacks have come back for timestamp_ms."""
+        with self._frame_holds_mutex:
+            self._frame_holds[timestamp_ms] = [slot, callback_count]
+
+    def _release_frame_hold(self, timestamp_ms):
+        """Called once per result callback (or skipped submission) for
+        a held frame. Gives the slot back when nobody needs it."""
+        slot = None
+        with self._frame_holds_mutex:
+            hold = self._frame_holds.get(timestamp_ms)
+            if hold is None:
+                return
+            hold[1] -= 1
+            if hold[1] <= 0:
+                del self._frame_holds[timestamp_ms]
+                slot = hold[0]
+        if slot:
+            self._frame_ring_buffer.release(slot)
+
+    def _skip_frame_result(self, timestamp_ms):
+        """For a held frame that one of the landmarkers isn't going to
+        give us a result for after all."""
+        self._release_frame_hold(timestamp_ms)
+        self._result_coalescer.cancel(timestamp_ms)
+
+    def _submit_frame(self, name, landmarker, in_flight_window, mp_image, timestamp_ms):
+        """Queue up a held frame on one landmarker, if there's room in
+        its window. Otherwise skip it (to avoid a deadlock). name is
+        just for the pipeline stats.
+
+        For landmarkers in worker processes, mp_image is the
+        SharedFrameBuffer holding the frame instead.
+
+        """
+
+        if not in_flight_window.try_submit(timestamp_ms):
+            self._skip_frame_result(timestamp_ms)
+            return
+
+        submit_start_time = pipeline_stats.now()
+        try:
+            landmarker.detect_async(mp_image, timestamp_ms)
+            self._pipeline_stats.record_since(
+                name + "_submit", submit_start_time)
+        except Exception:
+            in_flight_window.cancel(timestamp_ms)
+            self._skip_frame_result(timestamp_ms)
+            raise
+
+    def _expire_in_flight_frames(self):
+        """Give up on frames that MediaPipe never answered."""
+        for window in [ self._in_flight_face, self._in_flight_hands ]:
+            for timestamp_ms in window.expire(self.in_flight_timeout):
+                self._skip_frame_result(timestamp_ms)
+
     # Create a face landmarker instance with the live stream mode:
     def _handle_result_face(
             self,
             result: mediapipe.tasks.vision.FaceLandmarkerResult,
             output_image: mediapipe.Image, timestamp_ms: int):
 
-        for transform in result.facial_transformation_matrixes:
-            self.time_since_last_face_detection = 0.0
-            self.last_head_position = kiri_math.get_origin_from_mediapipe_transform_matrix(transform) / 100.0
-            self.last_head_quat = kiri_math.quaternion_mirror_rotation_on_x_axis(
-                kiri_math.matrix_to_quaternion(transform))
+        # MediaPipe is done with the input frame now.
+        if self._in_flight_face.complete(timestamp_ms):
+            self._release_frame_hold(timestamp_ms)
+            self._pipeline_stats.record(
+                "face_inference", self._in_flight_face.last_latency)
+
+        recorder = self._result_recorder
+        if recorder:
+            recorder.record_face(result, timestamp_ms)
+
+        self._last_face_result_time = timestamp_ms / 1000.0
+
+        postprocess_start_time = pipeline_stats.now()
+
+        head_state = self.head_state
 
-        for face in result.face_blendshapes:
-            self.time_since_last_face_detection = 0.0
-            for shape in face:
+        # Do the math before taking the lock, so the output thread
+        # isn't kept waiting on it.
+        head_poses = [
+            (kiri_math.get_origin_from_mediapipe_transform_matrix(transform) / 100.0,
+             kiri_math.quaternion_mirror_rotation_on_x_axis(
+                 kiri_math.matrix_to_quaternion(transform)))
+            for transform in result.facial_transformation_matrixes ]
 
-                # FIXME: Make this scaling value configurable. And
-                # move it into Godot.
-                self.last_blendshapes[shape.category_name] = shape.score # normalized
+        with self._tracking_state_lock:
 
-        with self.frames_queued_mutex:
-            self.frames_queued_face -= 1
+            for head_position, head_quat in head_poses:
+                head_state.missing_time = 0.0
+                head_state.position[:] = head_position
+                head_state.quat[:] = head_quat
+
+            for face in result.face_blendshapes:
+                head_state.missing_time = 0.0
+
+                # FIXME: Make this scaling value configurable. And move it
+                # into Godot.
+                head_state.set_blendshapes(face) # normalized
+
+        self._pipeline_stats.record_since(
+            "face_postprocess", postprocess_start_time)
+
+        self._result_coalescer.result_arrived(timestamp_ms)
 
     # FIXME: If we ever come back to it, finish this.
     def _handle_result_pose(
@@ -260,12 +1140,32 @@ class MediaPipeTracker:
             result: mediapipe.tasks.vision.HandLandmarkerResult,
             output_image: mediapipe.Image, timestamp_ms: int):
 
-        self._last_hand_result_timestamp = timestamp_ms
         # self._write_log("HAND RESULTS: ", timestamp_ms)
         # return
 
-        with self.frames_queued_mutex:
-            self.frames_queued_hands -= 1
+        # MediaPipe is done with the input frame now.
+        if self._in_flight_hands.complete(timestamp_ms):
+            self._release_frame_hold(timestamp_ms)
+            self._pipeline_stats.record(
+                "hands_inference", self._in_flight_hands.last_latency)
+
+        recorder = self._result_recorder
+        if recorder:
+            recorder.record_hands(result, timestamp_ms)
+
+        self._last_hands_result_time = timestamp_ms / 1000.0
+
+        postprocess_start_time = pipeline_stats.now()
+        with self._tracking_state_lock:
+            self._process_hand_result(result)
+        self._pipeline_stats.record_since(
+            "hands_postprocess", postprocess_start_time)
+
+        self._result_coalescer.result_arrived(timestamp_ms)
+
+    def _process_hand_result(self, result):
+        """Update hand_states from a hand landmarker result. Call with
+        _tracking_state_lock held."""
 
         # Check if hand count changed. Pause tracking for a moment if we
         # did.
@@ -281,8 +1181,8 @@ class MediaPipeTracker:
 
         # Default confidence to zero in case we don't see any hand
         # tracking data for a hand.
-        self.last_hand_data["right"]["position_confidence"] = 0.0
-        self.last_hand_data["left"]["position_confidence"] = 0.0
+        self.hand_states["right"].position_confidence = 0.0
+        self.hand_states["left"].position_confidence = 0.0
 
         assert(
             len(result.hand_landmarks) == len(result.hand_world_landmarks) and
@@ -299,21 +1199,21 @@ class MediaPipeTracker:
             hand_world_landmarks = result.hand_world_landmarks[index]
             handedness = result.handedness[index]
 
-            vec_middle_of_knuckles = (
-                kiri_math.landmark_to_vector(result.hand_world_landmarks[index][5]) + \
-                kiri_math.landmark_to_vector(result.hand_world_landmarks[index][17])) / 2.0
+            # Convert all the world landmarks for this hand at once,
+            # into a (21,3) array.
+            world_points = kiri_math.landmarks_to_array(hand_world_landmarks)
+            wrist_position_local = world_points[0]
+
+            vec_middle_of_knuckles = (world_points[5] + world_points[17]) / 2.0
 
             # This is really the hand "forward".
             vec_wrist_to_knuckles = \
-                vec_middle_of_knuckles - \
-                kiri_math.landmark_to_vector(result.hand_world_landmarks[index][0])
+                vec_middle_of_knuckles - wrist_position_local
             vec_wrist_to_knuckles = \
                 vec_wrist_to_knuckles / numpy.linalg.norm(vec_wrist_to_knuckles)
 
             # Direction of the knuckles (outer side towards thumb side)
-            vec_knuckles_direction = \
-                kiri_math.landmark_to_vector(result.hand_world_landmarks[index][5]) - \
-                kiri_math.landmark_to_vector(result.hand_world_landmarks[index][17])
+            vec_knuckles_direction = world_points[5] - world_points[17]
             vec_knuckles_direction = \
                 vec_knuckles_direction / numpy.linalg.norm(vec_knuckles_direction)
 
@@ -370,20 +1270,20 @@ class MediaPipeTracker:
 
                     if len(handedness_decided):
                         # FIXME: Use actual time? Maybe frame counting is better.
-                        self.last_hand_data[handedness_decided.lower()]["position_confidence_time"] += handedness[0].score
+                        self.hand_states[handedness_decided].position_confidence_time += handedness[0].score
 
                 else:
 
                     # Just reset confidence for whatever we think
                     # there's a chance that this is.
-                    self.last_hand_data[handedness[0].category_name.lower()][
-                        "position_confidence_time"] = 0.0
+                    self.hand_states[handedness[0].category_name.lower()] \
+                        .position_confidence_time = 0.0
 
                     if self.debug_try_closest_hand_when_confidence_low:
                         # Don't trust the handedness from the API. Instead
                         # just find which hand was closest last frame.
-                        if numpy.linalg.norm(self.last_hand_data["left"]["position"] - hand_viewspace_origin) < \
-                           numpy.linalg.norm(self.last_hand_data["right"]["position"] - hand_viewspace_origin):
+                        if numpy.linalg.norm(self.hand_states["left"].position - hand_viewspace_origin) < \
+                           numpy.linalg.norm(self.hand_states["right"].position - hand_viewspace_origin):
                             handedness_decided = "left"
                         else:
                             handedness_decided = "right"
@@ -403,23 +1303,19 @@ class MediaPipeTracker:
             # General coordinate space wiggling.
             vec_up *= -1
 
-            # Generate a hand rotation matrix.
+            # Generate a hand rotation matrix. Each row is one axis.
             mat_hand_rotation = numpy.array([
-                vec_wrist_to_knuckles  / numpy.linalg.norm(vec_wrist_to_knuckles),
-                vec_up                 / numpy.linalg.norm(vec_up),
-                vec_horizontal         / numpy.linalg.norm(vec_horizontal)
+                vec_wrist_to_knuckles,
+                vec_up,
+                vec_horizontal
                 ])
+            mat_hand_rotation /= numpy.linalg.norm(
+                mat_hand_rotation, axis=1)[:, numpy.newaxis]
 
-            # Convert all landmarks to hand-local space and add them to
-            # the output list.
-            wrist_position_local = \
-                kiri_math.landmark_to_vector(result.hand_world_landmarks[index][0])
-            output_hand_landmarks = []
-            for i in range(0, len(result.hand_world_landmarks[index])):
-                local_pos = (kiri_math.landmark_to_vector(result.hand_world_landmarks[index][i]) -
-                         wrist_position_local)
-                output_hand_landmarks.append(
-                    mat_hand_rotation.dot(local_pos))
+            # Convert all landmarks to hand-local space, as one (21,3)
+            # array. Same as mat_hand_rotation.dot() on each one.
+            output_hand_landmarks = \
+                (world_points - wrist_position_local) @ mat_hand_rotation.T
 
             # Set outputs.
             if len(handedness) > 0:
@@ -429,86 +1325,54 @@ class MediaPipeTracker:
 
                 if len(handedness_decided):
 
-                    hand_to_change = self.last_hand_data[handedness_decided]
-                    if hand_to_change["position_confidence_time"] >= self.confidence_time_threshold:
+                    hand_to_change = self.hand_states[handedness_decided]
+                    if hand_to_change.position_confidence_time >= self.confidence_time_threshold:
 
                         # # FIXME: Re-enable this, but make it settable how much effect it has.
                         # # Smooth out the depth value to reduce noise.
                         # last_hand_position_smooth_z = \
-                        #     self.last_hand_data["right"]["position"][2] * 0.8 + hand_viewspace_origin[2] * 0.2
+                        #     self.hand_states["right"].position[2] * 0.8 + hand_viewspace_origin[2] * 0.2
                         # hand_viewspace_origin[2] = last_hand_position_smooth_z
 
-                        hand_to_change["position"] = \
-                            lerp(
-                                hand_viewspace_origin,
-                                hand_to_change["position"],
-                                handedness[0].score / smoothness)
+                        # FIXME: This used to lerp towards the new
+                        # position by handedness[0].score / smoothness,
+                        # but the result was immediately overwritten
+                        # with the unsmoothed position anyway.
+                        hand_to_change.position[:] = hand_viewspace_origin
 
-                        hand_to_change["position"] = hand_viewspace_origin
-
-                        hand_to_change["position_confidence"] = handedness[0].score
-                        hand_to_change["rotation_matrix"] = mat_hand_rotation
-                        hand_to_change["landmarks"] = output_hand_landmarks
+                        hand_to_change.position_confidence = handedness[0].score
+                        hand_to_change.rotation_matrix[:] = mat_hand_rotation
+                        hand_to_change.set_landmarks(output_hand_landmarks)
 
         # Reset any hand that we haven't seen this frame.
         for hand in hands_seen.keys():
             if not hands_seen[hand]:
-                self.last_hand_data[hand]["position_confidence_time"] = 0.0
+                self.hand_states[hand].position_confidence_time = 0.0
 
-    def _tracker_worker_thread_func(self):
+    def _reset_hand_tracking_state(self):
+        """Re-init hand tracking data. Happens every time we restart
+        the tracker (or replay a result recording)."""
 
-        try:
+        with self._tracking_state_lock:
+            for hand_state in self.hand_states.values():
+                hand_state.reset()
 
+        # We'll pause tracking if another hand has come on-screen, because it
+        # can get confused between the two of them when one has the wrong
+        # handedness (but we can't easily distinguish it yet from the one that's
+        # already on-screen). FIXME: Do it with a distance-check?
+        self.time_since_hand_count_changed = 0.0
 
-            # Deadlock-avoidance.
+        self.last_hand_count = 0
 
-            self._write_log("locking mutex before init mediapipe")
-            with self.the_big_ugly_mutex:
+        self.debug_try_closest_hand_when_confidence_low = False
 
-                self._init_mediapipe()
+    def _capture_thread_func(self):
 
-                self._write_log("Initializing MediaPipe")
+        try:
 
-                # Re-init hand tracking data every time we restart the
-                # tracker.
-                for side in ["left", "right"]:
-                    self.last_hand_data[side]["position"]             = numpy.array([0.0, 0.0, 0.0])
-                    self.last_hand_data[side]["position_confidence"]  = 0.0
-                    self.last_hand_data[side]["rotation_matrix"]      = numpy.array([[1.0, 0.0, 0.0], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0]])
-                    self.last_hand_data[side]["landmarks"]            = []
-
-                # We'll pause tracking if another hand has come on-screen, because it
-                # can get confused between the two of them when one has the wrong
-                # handedness (but we can't easily distinguish it yet from the one that's
-                # already on-screen). FIXME: Do it with a distance-check?
-                self.time_since_hand_count_changed = 0.0
-
-                self.last_hand_count = 0
-
-                self.debug_try_closest_hand_when_confidence_low = False
-
-            input_image = None
-            success = True
-            start_time = time.time()
-            frame_count = 0
-
-            # We'll send this when we're panicking from too many frames queued, as
-            # a last-ditch attempt to un-clog the queue before we get a deadlock
-            # thanks to the MediaPipe bug.
-            blank_image_cv2 = numpy.zeros((1,1,3), dtype=numpy.uint8)
-            blank_image_mp = mediapipe.Image(
-                mediapipe.ImageFormat.SRGB,
-                data=blank_image_cv2)
-
-            # Main capturing loop.
-            last_frame_time = 0
             while not self.should_quit_threads:
 
-                # Wait for the minimum frame time.
-                time_to_sleep = self.minimum_frame_time - (time.time() - last_frame_time)
-                if time_to_sleep > 0.0:
-                    time.sleep(time_to_sleep)
-
                 # If the video device got disconnected, reconnect it.
                 try:
                     self._open_video_device()
@@ -519,143 +1383,213 @@ class MediaPipeTracker:
                     # switch it on the main thread.
                     pass
 
+                # Grab a reference to the device so we don't need to
+                # hold the mutex during the read. If the device gets
+                # switched out from under us, this one just goes away
+                # after we're done with it.
                 with self.the_big_ugly_mutex:
 
-                    last_frame_time = time.time()
-                    last_timestamp_used = int(time.time() * 1000)
+                    # No camera at the moment. Sleep until one gets
+                    # selected, or until it's time to retry one that
+                    # failed to open.
+                    if not self.video_device_capture and not self.should_quit_threads:
+                        if self._video_source_selected():
+                            self._video_device_condition.wait(self.video_device_retry_time)
+                        else:
+                            self._video_device_condition.wait()
 
-                    # Capture a frame.
-                    if self.video_device_capture:
-                        success, image = self.video_device_capture.read()
-                    else:
-                        # No camera connected at the moment. Just feed in
-                        # blank images.
-                        success = True
-                        image = blank_image_cv2.copy()
+                    video_device_capture = self.video_device_capture
+
+                if not video_device_capture:
+                    continue
+
+                replaying = isinstance(video_device_capture, video_replay.ReplayCapture)
+
+                # Recordings wait for the tracker to catch up, instead
+                # of dropping frames.
+                if replaying:
+                    slot = self._frame_ring_buffer.begin_write(0.1)
+                else:
+                    slot = self._frame_ring_buffer.begin_write()
+
+                if not slot:
+                    # Everything's busy. Still need to pull the frame
+                    # off the camera so it doesn't queue up.
+                    if not replaying:
+                        video_device_capture.grab()
+                    continue
+
+                # Read straight into the slot's buffer. OpenCV only
+                # allocates a new one if the frame size changed.
+                read_start_time = pipeline_stats.now()
+                if replaying:
+                    success, image, capture_time = video_device_capture.read(slot.image)
+                    if video_device_capture.finished:
+                        self._frame_ring_buffer.cancel_write(slot)
+                        self._finish_replay(video_device_capture)
+                        continue
+                else:
+                    success, image = video_device_capture.read(slot.image)
+                    capture_time = time.time()
+
+                if success:
+                    slot.image = image
+                    slot.capture_perf_time = pipeline_stats.now()
+                    self._pipeline_stats.record(
+                        "camera_read", slot.capture_perf_time - read_start_time)
+                    self._frame_ring_buffer.finish_write(slot, capture_time)
+                else:
+                    self._frame_ring_buffer.cancel_write(slot)
+                    # Don't spin if the device is failing.
+                    time.sleep(self.minimum_frame_time)
 
-                    if success:
+        except Exception as e:
+
+            exception_string_generator = traceback.TracebackException.from_exception(e)
+            exception_string = "".join(exception_string_generator.format())
+            self._write_log(exception_string)
+
+    def _tracker_worker_thread_func(self):
+
+        try:
+
+
+            # Deadlock-avoidance.
 
-                        # Convert image to MediaPipe.
-                        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+            self._write_log("locking mutex before init mediapipe")
+            with self.the_big_ugly_mutex:
+
+                self._init_mediapipe()
+
+                self._write_log("Initializing MediaPipe")
+
+                self._reset_hand_tracking_state()
+
+            # Main tracking loop.
+            last_frame_time = 0
+            while not self.should_quit_threads:
+
+                # Wait for the minimum frame time. Recordings go as
+                # fast as they can (or get paced by the capture thread).
+                if self.video_source_path == "":
+                    time_to_sleep = self.minimum_frame_time - (time.time() - last_frame_time)
+                    if time_to_sleep > 0.0:
+                        time.sleep(time_to_sleep)
+
+                # Wait for the capture thread to hand us something.
+                # This is always the newest frame. Anything older is
+                # already stale.
+                self._expire_in_flight_frames()
+
+                # Without a camera there's nothing to do. Park here
+                # instead of spinning until one shows up. Finish off
+                # any frames that are already captured first, though.
+                with self.the_big_ugly_mutex:
+                    while not self.video_device_capture and \
+                          not self._frame_ring_buffer.has_ready_frames() and \
+                          not self.should_quit_threads:
+                        self._video_device_condition.wait()
+
+                slot = self._frame_ring_buffer.take_newest(0.1)
+                if not slot:
+                    continue
+
+                # The slot might get reused before we're done, so hang
+                # onto this.
+                frame_capture_perf_time = slot.capture_perf_time
+                self._pipeline_stats.record_since(
+                    "frame_queue", frame_capture_perf_time)
+
+                with self.the_big_ugly_mutex:
+
+                    last_frame_time = time.time()
+
+                    # Generate a timestamp to feed into the MediaPipe
+                    # system from when the frame was actually
+                    # captured. If we're still somehow inside the same
+                    # millisecond as the last processed image, then skip
+                    # this frame.
+                    this_time = int(slot.capture_time * 1000)
+                    if this_time <= self._last_timestamp_used:
+                        self._frame_ring_buffer.release(slot)
+                        continue
+
+                    # If nothing's moved since the last frame the
+                    # landmarkers saw, don't bother running them. No new
+                    # results means no new packet, so SnekStudio just
+                    # keeps the last ones.
+                    if self._motion_gate.check(slot.image, slot.capture_time):
+                        run_landmarkers = True
+                    else:
+                        run_landmarkers = False
+                        self._frame_ring_buffer.release(slot)
+
+                    if run_landmarkers:
+
+                        # Convert image to MediaPipe, into the slot's
+                        # own RGB buffer. OpenCV only allocates a new
+                        # one if the frame size changed. For worker
+                        # processes it has to be in shared memory, so we
+                        # set that up ourselves.
+                        convert_start_time = pipeline_stats.now()
+                        if self._landmarkers_in_worker_processes:
+                            self._get_shared_rgb_buffer(slot)
+                        if slot.rgb_image is not None:
+                            slot.rgb_image.flags.writeable = True
+                        slot.rgb_image = cv2.cvtColor(
+                            slot.image, cv2.COLOR_BGR2RGB, slot.rgb_image)
                         # FIXME: Find out why we do this. I think it was
                         # mentioned in the MediaPipe tutorial.
-                        image.flags.writeable = False
-                        mp_image = mediapipe.Image(
-                            image_format=mediapipe.ImageFormat.SRGB,
-                            data=image)
-
-                        # Generate a timestamp to feed into the MediaPipe
-                        # system. If we're still somehow inside the same
-                        # millisecond as the last processed image, then skip
-                        # this frame.
-                        this_time = int(time.time() * 1000)
-                        if this_time <= last_timestamp_used:
-                            continue
-
-                        # Check to see if we have too many face tracking
-                        # frames queued.
-                        need_reset = False
-                        with self.frames_queued_mutex:
-                            if self.frames_queued_face > 5:
-                                need_reset = True
-                            else:
-                                self.frames_queued_face += 1
-
-                        # This will get reset immediately if we detect
-                        # a face. Otherwise it'll be how many frames
-                        # since the last face detection.
-                        self.time_since_last_face_detection += 1.0
-
-                        # Reset if we have too face frames queued. Avoid a
-                        # deadlock.
-                        if need_reset:
-                            # Deadlock-avoidance.
-                            self.landmarker._runner.restart()
-                            self.frames_queued_face = 0
+                        slot.rgb_image.flags.writeable = False
+
+                        if self._landmarkers_in_worker_processes:
+                            # Worker processes just need to know where
+                            # to find it.
+                            mp_image = slot.rgb_shared
                         else:
-                            self.landmarker.detect_async(mp_image, this_time)
+                            mp_image = mediapipe.Image(
+                                image_format=mediapipe.ImageFormat.SRGB,
+                                data=slot.rgb_image)
+                        self._pipeline_stats.record_since(
+                            "convert", convert_start_time)
+
+                        # Hang onto the slot until both landmarkers are
+                        # done with it. Anything we don't actually submit
+                        # gets released right away below.
+                        self._hold_frame(slot, this_time, 2)
+                        self._result_coalescer.expect(
+                            this_time, 2, frame_capture_perf_time)
+
+                        # Face
+                        if self._face_schedule.is_due(slot.capture_time):
+
+                            # This will get reset immediately if we detect
+                            # a face. Otherwise it'll be how many frames
+                            # since the last face detection.
+                            with self._tracking_state_lock:
+                                self.head_state.missing_time += 1.0
+
+                            self._submit_frame(
+                                "face", self.landmarker, self._in_flight_face,
+                                mp_image, this_time)
+                        else:
+                            self._skip_frame_result(this_time)
 
                         # Hands
-
-                        # If the last result we got back was too much time
-                        # since the last one we queued up, then wait until
-                        # some amount of time (which we guess in the most
-                        # convoluted way possible) has passed.
-                        #
-                        # FIXME: Make this less stupid. Make it make
-                        # sense. Then apply it to the face tracking.
-                        hand_landmarker_time_skew = self._last_hand_detect_timestamp - self._last_hand_result_timestamp
-                        if hand_landmarker_time_skew > 50: # FIXME: Make configurable (milliseconds)
-                            self._last_hand_result_timestamp += this_time - self._last_hand_detect_timestamp
+                        if self._hand_schedule.is_due(slot.capture_time):
+                            self._submit_frame(
+                                "hands", self.landmarker_hands, self._in_flight_hands,
+                                mp_image, this_time)
                         else:
-                            # Check to see if we have too many hand tracking
-                            # frames queued.
-                            need_reset = False
-                            with self.frames_queued_mutex:
-                                if self.frames_queued_face > 5:
-                                    need_reset = True
-                                else:
-                                    self.frames_queued_hands += 1
-
-                            # If we do have too many frames queued, just reset
-                            # the tracker to avoid a deadlock.
-                            if need_reset:
-                                self.landmarker_hands._runner.restart()
-                                self.frames_queued_hands = 0
-                            else:
-                                self.landmarker_hands.detect_async(mp_image, this_time)
-                                self._last_hand_detect_timestamp = this_time
-
-                        # Track the last timestamp because we have to keep
-                        # these monotonically increasing and we can't send
-                        # the same timestamp twice.
-                        last_timestamp_used = this_time
-
-                        # Generate the dictionary we're going to send back
-                        # to SnekStudio.
-                        output_data = {
-                            "hand_left_origin" :
-                                self.last_hand_data["left"]["position"].tolist(),
-                            "hand_left_rotation" :
-                                self.last_hand_data["left"]["rotation_matrix"].tolist(),
-                            "hand_left_score" :
-                                self.last_hand_data["left"]["position_confidence"],
-                            "hand_right_origin" :
-                                self.last_hand_data["right"]["position"].tolist(),
-                            "hand_right_rotation" :
-                                self.last_hand_data["right"]["rotation_matrix"].tolist(),
-                            "hand_right_score" :
-                                self.last_hand_data["right"]["position_confidence"],
-                            "head_origin" :
-                                self.last_head_position.tolist(),
-                            "head_quat" :
-                                self.last_head_quat.tolist(),
-                            "blendshapes" : self.last_blendshapes,
-                            "head_missing_time" : self.time_since_last_face_detection
-                        }
-
-                        output_landmarks_left = []
-                        for k in self.last_hand_data["left"]["landmarks"]:
-                            output_landmarks_left.append(k.tolist())
-
-                        output_landmarks_right = []
-                        for k in self.last_hand_data["right"]["landmarks"]:
-                            output_landmarks_right.append(k.tolist())
-
-                        output_data["hand_landmarks_left"] = output_landmarks_left
-                        output_data["hand_landmarks_right"] = output_landmarks_right
-
-                        output_data_json = json.dumps(output_data, indent=4).encode("utf-8")
-
-                        with self.frames_queued_mutex:
-                            status_packet_str = "Tracking data sending. (Queue: %2d hand, %2d face)" % (self.frames_queued_hands, self.frames_queued_face)
-
-                        # FIXME: This is too spammy.
-                        # self._write_log(status_packet_str)
-
-                        # Output the packet.
-                        if self.video_device_capture:
-                            self._udp_socket.sendto(output_data_json, ("127.0.0.1", self.udp_port_number))
+                            self._skip_frame_result(this_time)
+
+                    # Track the last timestamp because we have to keep
+                    # these monotonically increasing and we can't send
+                    # the same timestamp twice.
+                    self._last_timestamp_used = this_time
+
+                    # Packets go out from _output_thread_func when the
+                    # results come in.
 
             self._write_log("Quitting")
 
@@ -665,6 +1599,236 @@ class MediaPipeTracker:
             exception_string = "".join(exception_string_generator.format())
             self._write_log(exception_string)
 
+    def _output_thread_func(self):
+        """Sends a tracking packet whenever there are new results (see
+        ResultCoalescer)."""
+
+        try:
+
+            while not self.should_quit_threads:
+
+                output = self._result_coalescer.wait_for_output(0.1)
+                if not output:
+                    continue
+
+                capture_time, capture_perf_time = output
+
+                with self.the_big_ugly_mutex:
+                    self._send_tracking_data(capture_time)
+
+                if capture_perf_time is not None:
+                    self._pipeline_stats.record_since(
+                        "capture_to_send", capture_perf_time)
+
+        except Exception as e:
+
+            exception_string_generator = traceback.TracebackException.from_exception(e)
+            exception_string = "".join(exception_string_generator.format())
+            self._write_log(exception_string)
+
+    def _build_tracking_packet(self, capture_time):
+        """Encode the latest tracking state as a packet (binary or JSON,
+        depending on packet_format). Call with the mutex and
+        _tracking_state_lock held."""
+
+        build_start_time = pipeline_stats.now()
+
+        schema = self.head_state.blendshape_schema
+        include_schema = False
+        if schema[0] != self._blendshape_schema_id_sent or \
+           build_start_time - self._blendshape_schema_send_time >= self.blendshape_schema_interval:
+            include_schema = True
+            self._blendshape_schema_id_sent = schema[0]
+            self._blendshape_schema_send_time = build_start_time
+
+        sequence = self._packet_sequence
+        self._packet_sequence += 1
+
+        if self.packet_format != "json":
+
+            # The shared memory reader only sees the newest packet, so
+            # it would miss the ones that deltas are relative to.
+            if self._shared_memory_writer:
+                self._packet_encoder.force_keyframe()
+
+            output_packet = self._packet_encoder.encode(
+                sequence, capture_time,
+                self._last_face_result_time, self._last_hands_result_time,
+                time.time(),
+                self.head_state, self.hand_states["left"], self.hand_states["right"],
+                include_schema)
+
+            self._pipeline_stats.record_since("binary_encode", build_start_time)
+
+        else:
+
+            # Fill in the dictionary we're going to send back to
+            # SnekStudio.
+            output_data = self._output_data
+            self.hand_states["left"].write_output(output_data, "left")
+            self.hand_states["right"].write_output(output_data, "right")
+            self.head_state.write_output(output_data)
+            output_data["sequence"] = sequence
+            output_data["capture_time"] = capture_time
+            output_data["face_result_time"] = self._last_face_result_time
+            output_data["hands_result_time"] = self._last_hands_result_time
+            output_data["send_time"] = time.time()
+
+            if include_schema:
+                output_data["blendshape_schema"] = {
+                    "id" : schema[0],
+                    "names" : schema[1]
+                }
+            else:
+                output_data.pop("blendshape_schema", None)
+
+            encode_start_time = pipeline_stats.now()
+            self._pipeline_stats.record(
+                "build_output", encode_start_time - build_start_time)
+
+            output_packet = json.dumps(output_data).encode("utf-8")
+
+            self._pipeline_stats.record_since("json_encode", encode_start_time)
+
+        return output_packet
+
+    def _send_tracking_data(self, capture_time):
+        """Send the latest tracking state to SnekStudio. capture_time is
+        when the frame we just handled was captured. Call with the
+        mutex held."""
+
+        # The result callbacks can't change anything while we're
+        # reading it.
+        with self._tracking_state_lock:
+            output_packet = self._build_tracking_packet(capture_time)
+
+        # Output the packet. Anything too big for shared memory goes
+        # over UDP instead.
+        send_start_time = pipeline_stats.now()
+        if self._shared_memory_writer and self._shared_memory_writer.write(output_packet):
+            self._pipeline_stats.record_since("shared_memory_write", send_start_time)
+        else:
+            self._udp_socket.sendto(output_packet, ("127.0.0.1", self.udp_port_number))
+            self._pipeline_stats.record_since("udp_send", send_start_time)
+
+        # Every so often, send the stats too.
+        if self.latency_stats_interval > 0.0:
+            if send_start_time - self._last_latency_stats_time >= self.latency_stats_interval:
+                self._last_latency_stats_time = send_start_time
+                self._send_latency_stats_packet()
+
+    def get_latency_stats(self, reset=False):
+        """Timing for each pipeline stage (p50/p95/p99 and such, in
+        milliseconds), plus counts of frames we dropped along the
+        way."""
+
+        stats = {
+            "stages" : self._pipeline_stats.get_summary(),
+            "frames_dropped" : self._frame_ring_buffer.frames_dropped,
+            "face_frames_skipped" : self._in_flight_face.frames_skipped,
+            "face_frames_expired" : self._in_flight_face.frames_expired,
+            "hands_frames_skipped" : self._in_flight_hands.frames_skipped,
+            "hands_frames_expired" : self._in_flight_hands.frames_expired,
+            "motion_gate_frames_skipped" : self._motion_gate.frames_skipped,
+            "results_coalesced" : self._result_coalescer.results_coalesced
+        }
+
+        if self.packet_format == "binary_quantized":
+            stats["quantization_error"] = self._packet_encoder.max_error
+
+        if reset:
+            self._pipeline_stats.reset()
+
+        return stats
+
+    def _send_latency_stats_packet(self):
+
+        output_data = {
+            "latency_stats" : self.get_latency_stats()
+        };
+        output_data_json = json.dumps(output_data).encode("utf-8")
+        self._udp_socket.sendto(output_data_json, ("127.0.0.1", self.udp_port_number))
+
+    def replay_results(self, path, real_time=False):
+        """Push a result recording back through the result callbacks,
+        and send out the usual packets, without running the
+        landmarkers at all. Packets go out whenever the timestamp
+        changes.
+
+        Goes as fast as possible, unless real_time is set. Blocks until
+        it's done, and returns some throughput stats.
+
+        Raises RuntimeError if the tracker is running. The result
+        callbacks would also hand everything to the output thread, so
+        every packet would go out twice. Use stop_tracker() first.
+
+        """
+
+        if self._tracker_worker_thread:
+            raise RuntimeError(
+                "Can't replay results while the tracker is running.")
+
+        reader = result_recording.ResultReader(path)
+
+        with self.the_big_ugly_mutex:
+            self._reset_hand_tracking_state()
+
+        records_replayed = 0
+        packets_sent = 0
+        start_time = time.time()
+        first_timestamp = None
+        current_timestamp = None
+
+        try:
+            for record_type, timestamp_ms, result in reader:
+
+                if current_timestamp is not None and timestamp_ms != current_timestamp:
+                    with self.the_big_ugly_mutex:
+                        self._send_tracking_data(current_timestamp / 1000.0)
+                    packets_sent += 1
+
+                if first_timestamp is None:
+                    first_timestamp = timestamp_ms
+                current_timestamp = timestamp_ms
+
+                if real_time:
+                    time_to_sleep = start_time + (timestamp_ms - first_timestamp) / 1000.0 - time.time()
+                    if time_to_sleep > 0.0:
+                        time.sleep(time_to_sleep)
+
+                if record_type == result_recording.RECORD_FACE:
+                    # Normally happens when the frame is submitted.
+                    with self._tracking_state_lock:
+                        self.head_state.missing_time += 1.0
+                    self._handle_result_face(result, None, timestamp_ms)
+                elif record_type == result_recording.RECORD_HANDS:
+                    self._handle_result_hands(result, None, timestamp_ms)
+
+                records_replayed += 1
+
+            if current_timestamp is not None:
+                with self.the_big_ugly_mutex:
+                    self._send_tracking_data(current_timestamp / 1000.0)
+                packets_sent += 1
+
+        finally:
+            reader.close()
+
+        elapsed_time = time.time() - start_time
+        stats = {
+            "records" : records_replayed,
+            "packets" : packets_sent,
+            "seconds" : elapsed_time,
+            "packets_per_second" : packets_sent / max(elapsed_time, 0.000001)
+        }
+
+        self._write_log(
+            "Result replay finished: %d records, %d packets in %.3f seconds (%.1f packets per second)" % (
+                records_replayed, packets_sent, elapsed_time,
+                stats["packets_per_second"]))
+
+        return stats
+
     def start_tracker(self):
 
         if self._tracker_worker_thread:
@@ -672,20 +1836,46 @@ class MediaPipeTracker:
 
         assert(not self._tracker_worker_thread)
         self._write_log("Starting worker thread.")
+        self._frame_ring_buffer.reset()
+        with self._frame_holds_mutex:
+            self._frame_holds.clear()
+        self._in_flight_face.clear()
+        self._in_flight_hands.clear()
+        self._motion_gate.reset()
+        self._pipeline_stats.reset()
+        self._packet_sequence = 0
+        self._blendshape_schema_id_sent = -1
+        self._packet_encoder.force_keyframe()
+        self._result_coalescer.clear()
         self._tracker_worker_thread = threading.Thread(
             target=self._tracker_worker_thread_func,
             daemon=True)
         self._tracker_worker_thread.start()
+        self._capture_thread = threading.Thread(
+            target=self._capture_thread_func,
+            daemon=True)
+        self._capture_thread.start()
+        self._output_thread = threading.Thread(
+            target=self._output_thread_func,
+            daemon=True)
+        self._output_thread.start()
         self._write_log("Starting worker thread done.")
 
     def stop_tracker(self):
 
         assert(self._tracker_worker_thread)
-        self.should_quit_threads = True
+        with self.the_big_ugly_mutex:
+            self.should_quit_threads = True
+            self._video_device_condition.notify_all()
+        self._result_coalescer.quit()
         self._write_log("Waiting for worker thread to join.")
         self._tracker_worker_thread.join()
+        self._capture_thread.join()
+        self._output_thread.join()
         self._write_log("Worker thread joined.")
         self._tracker_worker_thread = None
+        self._capture_thread = None
+        self._output_thread = None
         self.should_quit_threads = False
 
 
@@ -707,6 +1897,77 @@ class MediaPipeTracker:
             with self.the_big_ugly_mutex:
                 self.udp_port_number = new_settings_dict["udp_port_number"]
 
+        if "face_max_frames_in_flight" in new_settings_dict:
+            self._in_flight_face.window_size = max(1, int(new_settings_dict["face_max_frames_in_flight"]))
+
+        if "hand_max_frames_in_flight" in new_settings_dict:
+            self._in_flight_hands.window_size = max(1, int(new_settings_dict["hand_max_frames_in_flight"]))
+
+        if "face_tracking_rate" in new_settings_dict:
+            with self.the_big_ugly_mutex:
+                self._face_schedule.rate = float(new_settings_dict["face_tracking_rate"])
+
+        if "hand_tracking_rate" in new_settings_dict:
+            with self.the_big_ugly_mutex:
+                self._hand_schedule.rate = float(new_settings_dict["hand_tracking_rate"])
+
+        if "packet_format" in new_settings_dict:
+            with self.the_big_ugly_mutex:
+                if new_settings_dict["packet_format"] in [ "json", "binary", "binary_quantized" ]:
+                    self.packet_format = new_settings_dict["packet_format"]
+                    self._packet_encoder.quantize = \
+                        self.packet_format == "binary_quantized"
+                    # Make sure the new format gets the blendshape
+                    # names (and a keyframe) right away.
+                    self._blendshape_schema_id_sent = -1
+                    self._packet_encoder.force_keyframe()
+
+        if "latency_stats_interval" in new_settings_dict:
+            with self.the_big_ugly_mutex:
+                self.latency_stats_interval = float(new_settings_dict["latency_stats_interval"])
+
+        if "motion_gate_threshold" in new_settings_dict:
+            with self.the_big_ugly_mutex:
+                self._motion_gate.threshold = float(new_settings_dict["motion_gate_threshold"])
+
+        if "motion_gate_max_skip_time" in new_settings_dict:
+            with self.the_big_ugly_mutex:
+                self._motion_gate.max_skip_time = float(new_settings_dict["motion_gate_max_skip_time"])
+
+        if "video_source_real_time" in new_settings_dict:
+            with self.the_big_ugly_mutex:
+                self.video_source_real_time = bool(new_settings_dict["video_source_real_time"])
+                if isinstance(self.video_device_capture, video_replay.ReplayCapture):
+                    self.video_device_capture.real_time = self.video_source_real_time
+
+        if "video_source_fps" in new_settings_dict:
+            with self.the_big_ugly_mutex:
+                self.video_source_fps = max(1.0, float(new_settings_dict["video_source_fps"]))
+
+        # Switching between the camera and a recording means switching
+        # landmarker running modes, so they have to be re-created
+        # before any frames come in.
+        if "video_source_path" in new_settings_dict:
+            if new_settings_dict["video_source_path"] != self.video_source_path:
+                with self.the_big_ugly_mutex:
+                    self.video_source_path = new_settings_dict["video_source_path"]
+                    self._replay_finished = False
+                    self.video_device_capture = None
+                    self._write_log("Video source changed, reinitializing MediaPipe")
+                    self._init_mediapipe()
+                self._open_video_device()
+
+        if "result_recording_path" in new_settings_dict:
+            if new_settings_dict["result_recording_path"] != self.result_recording_path:
+                self.result_recording_path = new_settings_dict["result_recording_path"]
+                self._set_result_recording_path(self.result_recording_path)
+
+        if "shared_memory_path" in new_settings_dict:
+            if new_settings_dict["shared_memory_path"] != self.shared_memory_path:
+                with self.the_big_ugly_mutex:
+                    self.shared_memory_path = new_settings_dict["shared_memory_path"]
+                    self._set_shared_memory_path(self.shared_memory_path)
+
         landmark_options_changed = False
 
         if "hand_confidence_time_threshold" in new_settings_dict:
@@ -744,11 +2005,53 @@ class MediaPipeTracker:
                 self.hand_presence_confidence = new_settings_dict["hand_presence_confidence"]
                 landmark_options_changed = True
 
+        if "use_worker_processes" in new_settings_dict:
+            with self.the_big_ugly_mutex:
+                if self.use_worker_processes != bool(new_settings_dict["use_worker_processes"]):
+                    self.use_worker_processes = bool(new_settings_dict["use_worker_processes"])
+                    landmark_options_changed = True
+
         if landmark_options_changed:
             with self.the_big_ugly_mutex:
                 self._write_log("Settings updated, reinitializing MediaPipe")
                 self._init_mediapipe()
 
+    def _set_result_recording_path(self, path):
+        """Start recording landmarker results to path, or stop if it's
+        empty."""
+
+        old_recorder = self._result_recorder
+        self._result_recorder = None
+        if old_recorder:
+            old_recorder.close()
+            self._write_log("Stopped recording results (%d records)" % old_recorder.records_written)
+
+        if path != "":
+            try:
+                self._result_recorder = result_recording.ResultRecorder(path)
+                self._write_log("Recording results to: %s" % path)
+            except OSError as e:
+                error_string = "Failed to start recording results: %s" % str(e)
+                self._write_log(error_string)
+                self._send_error_packet(error_string)
+
+    def _set_shared_memory_path(self, path):
+        """Start sending tracking packets through shared memory at path,
+        or go back to UDP if it's empty. Call with the mutex held."""
+
+        if self._shared_memory_writer:
+            self._shared_memory_writer.close()
+            self._shared_memory_writer = None
+
+        if path != "":
+            try:
+                self._shared_memory_writer = shared_memory_transport.SharedMemoryWriter(path)
+                self._write_log("Sending tracking data through shared memory: %s" % path)
+            except (OSError, ValueError) as e:
+                error_string = "Failed to open shared memory, using UDP: %s" % str(e)
+                self._write_log(error_string)
+                self._send_error_packet(error_string)
+
     def _shutdown_mediapipe(self):
 
         if self.landmarker:
@@ -762,6 +2065,13 @@ class MediaPipeTracker:
         # self.landmarker_pose = None
         self.landmarker_hands = None
 
+        # Shared memory only matters to the worker processes, which
+        # have been told to quit. (They have their own mappings, so
+        # it's fine if one is still finishing off a frame.)
+        for slot in self._frame_ring_buffer.get_all_slots():
+            self._free_shared_rgb_buffer(slot)
+        self._landmarkers_in_worker_processes = False
+
         # Grumblegrumblegrumble...
         gc.collect()
 
@@ -769,6 +2079,7 @@ class MediaPipeTracker:
         with self.the_big_ugly_mutex:
             self._close_video_device()
             self._shutdown_mediapipe()
+            self._set_shared_memory_path("")
 
 
 
@@ -792,6 +2103,14 @@ def update_settings(new_settings_dict):
     global mediapipe_controller
     mediapipe_controller.update_settings(new_settings_dict)
 
+def replay_results(path, real_time=False):
+    global mediapipe_controller
+    return mediapipe_controller.replay_results(path, real_time)
+
+def get_latency_stats(reset=False):
+    global mediapipe_controller
+    return mediapipe_controller.get_latency_stats(reset)
+
 
 def enumerate_camera_devices():
 
@@ -0,0 +1,84 @@
+#!/usr/bin/python3
+
+# Timing for each stage of the tracking pipeline, so we can tell
+# whether latency is coming from the camera, MediaPipe, or our own
+# code.
+#
+# Everything here is measured with time.perf_counter(), which is
+# monotonic, so wall clock adjustments don't throw it off.
+
+import collections
+import threading
+import time
+
+import numpy
+
+def now():
+    """Timestamp to measure stages with."""
+    return time.perf_counter()
+
+class LatencyHistogram:
+    """Keeps the last sample_count durations (in seconds) for one
+    stage, and gives percentiles over them."""
+
+    def __init__(self, sample_count=1000):
+        self._samples = collections.deque(maxlen=sample_count)
+        self.total_count = 0
+
+    def add(self, duration):
+        self._samples.append(duration)
+        self.total_count += 1
+
+    def get_summary(self):
+        """Percentiles and such, in milliseconds."""
+
+        if not len(self._samples):
+            return None
+
+        samples_ms = numpy.fromiter(self._samples, dtype=numpy.float64) * 1000.0
+        p50, p95, p99 = numpy.percentile(samples_ms, [50.0, 95.0, 99.0])
+
+        return {
+            "count" : self.total_count,
+            "p50" : float(p50),
+            "p95" : float(p95),
+            "p99" : float(p99),
+            "max" : float(samples_ms.max()),
+            "mean" : float(samples_ms.mean())
+        }
+
+class PipelineStats:
+    """A LatencyHistogram for each named stage. Safe to record from
+    any thread."""
+
+    def __init__(self, sample_count=1000):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self.sample_count = sample_count
+
+    def record(self, stage, duration):
+        with self._lock:
+            histogram = self._histograms.get(stage)
+            if histogram is None:
+                histogram = LatencyHistogram(self.sample_count)
+                self._histograms[stage] = histogram
+            histogram.add(duration)
+
+    def record_since(self, stage, start_time):
+        """Record the time from start_time (from now()) until now."""
+        self.record(stage, now() - start_time)
+
+    def get_summary(self):
+        """Dictionary of stage name to percentiles (in milliseconds),
+        for every stage that has anything recorded."""
+        with self._lock:
+            summary = {}
+            for stage, histogram in self._histograms.items():
+                stage_summary = histogram.get_summary()
+                if stage_summary:
+                    summary[stage] = stage_summary
+            return summary
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
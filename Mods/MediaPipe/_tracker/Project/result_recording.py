@@ -0,0 +1,299 @@
+#!/usr/bin/python3
+
+# Recording and playback of raw landmarker results.
+#
+# This lets us run the tracker's post-processing and output without
+# MediaPipe or a camera, for profiling, and for reproducing tracking
+# bugs from a recording somebody sends in.
+#
+# File format (all little-endian):
+#
+#   Header: b"KRES", uint16 version.
+#
+#   Then records, each one:
+#     uint8  record type
+#     int64  timestamp in milliseconds
+#     uint32 payload size in bytes
+#     payload
+#
+#   RECORD_NAME payload:
+#     uint16 name index, UTF-8 name. Blendshape and handedness names
+#     show up once as one of these, and get referred to by index
+#     afterwards.
+#
+#   RECORD_FACE payload:
+#     uint8 matrix count, then that many 4x4 float32 matrices.
+#     uint8 face count, then for each face:
+#       uint16 blendshape count, then that many (uint16 name index,
+#       float32 score).
+#
+#   RECORD_HANDS payload:
+#     uint8 hand count, then for each hand:
+#       uint8 handedness count, then that many (uint16 name index,
+#       float32 score, int16 category index).
+#       uint8 landmark count, then that many float32 (x, y, z)
+#       landmarks, followed by the same number of world landmarks.
+#
+# The file is append-only. If the tracker dies partway through a
+# record, the reader just stops at the last complete one.
+
+import struct
+import threading
+
+import numpy
+
+RECORD_NAME  = 0
+RECORD_FACE  = 1
+RECORD_HANDS = 2
+
+_file_magic = b"KRES"
+_file_version = 1
+
+_header_struct = struct.Struct("<4sH")
+_record_struct = struct.Struct("<BqI")
+
+_blendshape_dtype = numpy.dtype([
+    ("name", "<u2"),
+    ("score", "<f4")])
+
+_handedness_dtype = numpy.dtype([
+    ("name", "<u2"),
+    ("score", "<f4"),
+    ("index", "<i2")])
+
+# ----------------------------------------------------------------------
+# Stand-ins for MediaPipe's result types. They only have the parts that
+# the tracker actually looks at.
+
+class Category:
+    def __init__(self, index, score, category_name):
+        self.index = index
+        self.score = score
+        self.category_name = category_name
+        self.display_name = ""
+
+class Landmark:
+    def __init__(self, x, y, z):
+        self.x = x
+        self.y = y
+        self.z = z
+
+class FaceResult:
+    def __init__(self, face_blendshapes, facial_transformation_matrixes):
+        self.face_landmarks = []
+        self.face_blendshapes = face_blendshapes
+        self.facial_transformation_matrixes = facial_transformation_matrixes
+
+class HandResult:
+    def __init__(self, handedness, hand_landmarks, hand_world_landmarks):
+        self.handedness = handedness
+        self.hand_landmarks = hand_landmarks
+        self.hand_world_landmarks = hand_world_landmarks
+
+# ----------------------------------------------------------------------
+
+class ResultRecorder:
+    """Writes landmarker results to a file as they come in. Safe to
+    call from both result callbacks at once."""
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._file = open(path, "wb")
+        self._file.write(_header_struct.pack(_file_magic, _file_version))
+        self._name_indices = {}
+        self.records_written = 0
+
+    def _get_name_index(self, name):
+        # Call with the lock held.
+        if name not in self._name_indices:
+            index = len(self._name_indices)
+            self._name_indices[name] = index
+            self._write_record(
+                RECORD_NAME, 0,
+                struct.pack("<H", index) + name.encode("utf-8"))
+        return self._name_indices[name]
+
+    def _write_record(self, record_type, timestamp_ms, payload):
+        self._file.write(_record_struct.pack(
+            record_type, timestamp_ms, len(payload)))
+        self._file.write(payload)
+
+    def record_face(self, result, timestamp_ms):
+
+        with self._lock:
+
+            if not self._file:
+                return
+
+            chunks = []
+
+            matrices = result.facial_transformation_matrixes
+            chunks.append(struct.pack("<B", len(matrices)))
+            for matrix in matrices:
+                chunks.append(numpy.asarray(matrix, dtype="<f4").tobytes())
+
+            chunks.append(struct.pack("<B", len(result.face_blendshapes)))
+            for face in result.face_blendshapes:
+                shapes = numpy.empty(len(face), dtype=_blendshape_dtype)
+                for index, shape in enumerate(face):
+                    shapes[index] = (
+                        self._get_name_index(shape.category_name),
+                        shape.score)
+                chunks.append(struct.pack("<H", len(face)))
+                chunks.append(shapes.tobytes())
+
+            self._write_record(RECORD_FACE, timestamp_ms, b"".join(chunks))
+            self.records_written += 1
+
+    def record_hands(self, result, timestamp_ms):
+
+        with self._lock:
+
+            if not self._file:
+                return
+
+            chunks = []
+
+            chunks.append(struct.pack("<B", len(result.hand_landmarks)))
+            for hand_index in range(len(result.hand_landmarks)):
+
+                handedness = result.handedness[hand_index]
+                categories = numpy.empty(len(handedness), dtype=_handedness_dtype)
+                for index, category in enumerate(handedness):
+                    categories[index] = (
+                        self._get_name_index(category.category_name),
+                        category.score,
+                        category.index if category.index is not None else -1)
+                chunks.append(struct.pack("<B", len(handedness)))
+                chunks.append(categories.tobytes())
+
+                landmarks = result.hand_landmarks[hand_index]
+                world_landmarks = result.hand_world_landmarks[hand_index]
+                chunks.append(struct.pack("<B", len(landmarks)))
+                for landmark_list in [ landmarks, world_landmarks ]:
+                    chunks.append(numpy.array(
+                        [ (l.x, l.y, l.z) for l in landmark_list ],
+                        dtype="<f4").tobytes())
+
+            self._write_record(RECORD_HANDS, timestamp_ms, b"".join(chunks))
+            self.records_written += 1
+
+    def close(self):
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+
+class ResultReader:
+    """Reads back a file from ResultRecorder. Iterating over it gives
+    (record_type, timestamp_ms, result) for each face or hands record,
+    in the order they were recorded."""
+
+    def __init__(self, path):
+
+        self._file = open(path, "rb")
+        self._names = {}
+
+        header = self._file.read(_header_struct.size)
+        if len(header) < _header_struct.size:
+            raise ValueError("Not a result recording: %s" % path)
+
+        magic, version = _header_struct.unpack(header)
+        if magic != _file_magic:
+            raise ValueError("Not a result recording: %s" % path)
+        if version != _file_version:
+            raise ValueError("Unsupported result recording version: %d" % version)
+
+    def __iter__(self):
+
+        while True:
+
+            record_header = self._file.read(_record_struct.size)
+            if len(record_header) < _record_struct.size:
+                return
+
+            record_type, timestamp_ms, payload_size = \
+                _record_struct.unpack(record_header)
+
+            payload = self._file.read(payload_size)
+            if len(payload) < payload_size:
+                return
+
+            if record_type == RECORD_NAME:
+                self._names[struct.unpack_from("<H", payload)[0]] = \
+                    payload[2:].decode("utf-8")
+            elif record_type == RECORD_FACE:
+                yield record_type, timestamp_ms, self._parse_face(payload)
+            elif record_type == RECORD_HANDS:
+                yield record_type, timestamp_ms, self._parse_hands(payload)
+
+            # Anything else is from a newer version. Skip it.
+
+    def _parse_face(self, payload):
+
+        offset = 0
+
+        matrix_count = payload[offset]
+        offset += 1
+        matrices = []
+        for _ in range(matrix_count):
+            matrices.append(numpy.frombuffer(
+                payload, dtype="<f4", count=16,
+                offset=offset).reshape(4, 4).astype(numpy.float64))
+            offset += 16 * 4
+
+        face_count = payload[offset]
+        offset += 1
+        faces = []
+        for _ in range(face_count):
+            shape_count = struct.unpack_from("<H", payload, offset)[0]
+            offset += 2
+            shapes = numpy.frombuffer(
+                payload, dtype=_blendshape_dtype,
+                count=shape_count, offset=offset)
+            offset += shapes.nbytes
+            faces.append([
+                Category(index, float(shape["score"]), self._names[int(shape["name"])])
+                for index, shape in enumerate(shapes) ])
+
+        return FaceResult(faces, matrices)
+
+    def _parse_hands(self, payload):
+
+        offset = 0
+
+        handedness = []
+        hand_landmarks = []
+        hand_world_landmarks = []
+
+        hand_count = payload[offset]
+        offset += 1
+        for _ in range(hand_count):
+
+            category_count = payload[offset]
+            offset += 1
+            categories = numpy.frombuffer(
+                payload, dtype=_handedness_dtype,
+                count=category_count, offset=offset)
+            offset += categories.nbytes
+            handedness.append([
+                Category(int(category["index"]), float(category["score"]),
+                         self._names[int(category["name"])])
+                for category in categories ])
+
+            landmark_count = payload[offset]
+            offset += 1
+            for output_list in [ hand_landmarks, hand_world_landmarks ]:
+                points = numpy.frombuffer(
+                    payload, dtype="<f4",
+                    count=landmark_count * 3,
+                    offset=offset).reshape(landmark_count, 3)
+                offset += points.nbytes
+                output_list.append([
+                    Landmark(float(x), float(y), float(z))
+                    for x, y, z in points ])
+
+        return HandResult(handedness, hand_landmarks, hand_world_landmarks)
+
+    def close(self):
+        self._file.close()
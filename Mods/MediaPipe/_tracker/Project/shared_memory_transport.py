@@ -0,0 +1,143 @@
+#!/usr/bin/python3
+
+# Hands tracking packets to SnekStudio through a memory-mapped file
+# instead of over loopback UDP. There's only ever one packet in there:
+# the newest one. Older ones just get overwritten, so there's no queue
+# for the reader to drain, and no syscall per packet on our end.
+#
+# The packet is guarded by a sequence counter (a seqlock). The writer
+# makes it odd before it starts writing and even again when it's done.
+# A reader reads the counter, then the packet, then the counter again.
+# If they match and are even, the packet is consistent. Otherwise the
+# writer got in the way, and the reader should try again (or just use
+# the last one it had).
+#
+# That alone assumes the reader sees our stores in the order we made
+# them, which x86 guarantees, but ARM (and other weakly-ordered CPUs)
+# doesn't, and neither Python nor mmap gives us any memory barriers.
+# So there's also a checksum of the packet (the first four bytes of
+# its MD5) in the header, and the reader only takes the packet if that
+# matches too.
+#
+# File layout (all little-endian):
+#
+#   4 bytes  magic, b"KSHM"
+#   uint32   version
+#   uint64   sequence counter
+#   uint32   packet size
+#   4 bytes  packet checksum
+#   packet (whatever format the UDP packet would have been in)
+#
+# The reader on the other end is in MediaPipeController.gd.
+
+import hashlib
+import mmap
+import struct
+
+_file_magic = b"KSHM"
+_file_version = 1
+
+_header_struct = struct.Struct("<4sIQI4s")
+_sequence_struct = struct.Struct("<Q")
+_size_struct = struct.Struct("<I")
+
+_sequence_offset = 8
+_size_offset = 16
+_checksum_offset = 20
+_checksum_size = 4
+
+def _get_checksum(packet):
+    return hashlib.md5(packet, usedforsecurity=False).digest()[:_checksum_size]
+
+class SharedMemoryWriter:
+    """The tracker side. Packets bigger than max_packet_size can't go
+    through here, and write() returns False for them, so they can go
+    over UDP instead."""
+
+    def __init__(self, path, max_packet_size=65536):
+
+        self.path = path
+        self.max_packet_size = max_packet_size
+        self._sequence = 0
+
+        total_size = _header_struct.size + max_packet_size
+
+        with open(path, "w+b") as f:
+            f.truncate(total_size)
+            self._map = mmap.mmap(f.fileno(), total_size)
+
+        _header_struct.pack_into(
+            self._map, 0, _file_magic, _file_version, self._sequence, 0,
+            _get_checksum(b''))
+
+    def write(self, packet):
+
+        if not self._map:
+            return False
+
+        if len(packet) > self.max_packet_size:
+            return False
+
+        # Odd while we're writing.
+        self._sequence += 1
+        _sequence_struct.pack_into(self._map, _sequence_offset, self._sequence)
+
+        _size_struct.pack_into(self._map, _size_offset, len(packet))
+        self._map[_checksum_offset:_checksum_offset + _checksum_size] = \
+            _get_checksum(packet)
+        self._map[_header_struct.size:_header_struct.size + len(packet)] = packet
+
+        self._sequence += 1
+        _sequence_struct.pack_into(self._map, _sequence_offset, self._sequence)
+
+        return True
+
+    def close(self):
+        if self._map:
+            self._map.close()
+            self._map = None
+
+class SharedMemoryReader:
+    """The other side, for anything other than SnekStudio that wants to
+    read the tracker's output this way."""
+
+    def __init__(self, path):
+        self._file = open(path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.last_sequence = 0
+
+        magic, version, _, _, _ = _header_struct.unpack_from(self._map, 0)
+        if magic != _file_magic or version != _file_version:
+            self.close()
+            raise ValueError("Not a tracker shared memory file: %s" % path)
+
+    def read(self, retries=8):
+        """Returns the newest packet, or None if there hasn't been a new
+        one since last time (or we couldn't get a consistent one)."""
+
+        for _ in range(retries):
+
+            sequence = _sequence_struct.unpack_from(self._map, _sequence_offset)[0]
+            if sequence & 1:
+                continue
+            if sequence == self.last_sequence:
+                return None
+
+            size = _size_struct.unpack_from(self._map, _size_offset)[0]
+            checksum = self._map[_checksum_offset:_checksum_offset + _checksum_size]
+            packet = self._map[_header_struct.size:_header_struct.size + size]
+
+            if _sequence_struct.unpack_from(self._map, _sequence_offset)[0] == sequence and \
+               len(packet) == size and _get_checksum(packet) == checksum:
+                self.last_sequence = sequence
+                return packet
+
+        return None
+
+    def close(self):
+        if self._map:
+            self._map.close()
+            self._map = None
+        if self._file:
+            self._file.close()
+            self._file = None
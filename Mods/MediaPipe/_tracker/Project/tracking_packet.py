@@ -0,0 +1,383 @@
+#!/usr/bin/python3
+
+# Binary format for the tracking packets we send to SnekStudio over
+# UDP. This is a lot smaller (and a lot faster to build and parse)
+# than the JSON packets, which are still used when SnekStudio doesn't
+# ask for this format. Status, error and stats packets are always
+# JSON.
+#
+# The decoder on the other end is MediaPipeController_TrackingPacket.gd.
+# Keep the two in sync, and bump the version for any layout change.
+#
+# Packet layout (all little-endian):
+#
+#   Header:
+#     4 bytes  magic, b"KTRK"
+#     uint16   version
+#     uint16   flags (FLAG_*)
+#     uint32   sequence
+#     float64  capture_time
+#     float64  face_result_time
+#     float64  hands_result_time
+#     float64  send_time
+#     float32  head_missing_time
+#
+#   Counts:
+#     uint8  left hand landmark count
+#     uint8  right hand landmark count
+#     uint16 blendshape schema id
+#     uint16 blendshape count
+#
+#   Then the values, in this order:
+#     head origin (3), head quaternion (4)
+#     left hand origin (3), rotation matrix rows (9), score (1)
+#     right hand origin (3), rotation matrix rows (9), score (1)
+#     left hand landmarks, (x, y, z) each
+#     right hand landmarks, (x, y, z) each
+#     blendshape values
+#
+#   Without FLAG_QUANTIZED, those are all just float32.
+#
+#   With FLAG_QUANTIZED, each value is scaled into a uint16 over a fixed
+#   range (see _get_value_ranges()). Then comes:
+#     uint32 reference sequence
+#   If FLAG_KEYFRAME is set, that's followed by every value as a uint16.
+#   Otherwise, the packet only has what changed since the packet with the
+#   reference sequence:
+#     a bitmask with one bit per value (lowest bit first), set for each
+#     value that changed
+#     an int16 delta for each set bit, added to the old value modulo
+#     65536
+#   A delta packet can only be decoded if the last packet decoded was the
+#   reference one. Anything else has to wait for the next keyframe.
+#
+#   If FLAG_BLENDSHAPE_SCHEMA is set, the blendshape names come last:
+#     uint16 name count, then for each name a uint8 length and that
+#     many bytes of UTF-8.
+
+import struct
+
+import numpy
+
+FLAG_BLENDSHAPE_SCHEMA = 1
+FLAG_QUANTIZED         = 2
+FLAG_KEYFRAME          = 4
+
+packet_magic = b"KTRK"
+packet_version = 2
+
+_header_struct = struct.Struct("<4sHHIddddf")
+_counts_struct = struct.Struct("<BBHH")
+_reference_struct = struct.Struct("<I")
+
+_pose_value_count = 7 + 13 + 13
+
+# Ranges that quantized values have to fit into. Anything outside gets
+# clamped. Positions are in meters, landmarks are hand-local.
+_head_origin_range = (-8.0, 8.0)
+_hand_origin_range = (-16.0, 16.0)
+_rotation_range    = (-1.0, 1.0)
+# kiri_math.matrix_to_quaternion() doesn't normalize, and the head
+# quaternion's w can get up to 2.
+_quat_range        = (-2.0, 2.0)
+_score_range       = (0.0, 1.0)
+_landmark_range    = (-0.5, 0.5)
+_blendshape_range  = (0.0, 1.0)
+
+def _get_value_ranges(left_landmark_count, right_landmark_count, blendshape_count):
+    """(low, high) arrays for every value in a packet with these
+    counts."""
+
+    ranges = \
+        [ _head_origin_range ] * 3 + [ _quat_range ] * 4 + \
+        ([ _hand_origin_range ] * 3 + [ _rotation_range ] * 9 + [ _score_range ]) * 2 + \
+        [ _landmark_range ] * ((left_landmark_count + right_landmark_count) * 3) + \
+        [ _blendshape_range ] * blendshape_count
+
+    ranges = numpy.array(ranges, dtype=numpy.float64).reshape(-1, 2)
+    return ranges[:, 0], ranges[:, 1]
+
+def _encode_schema(names):
+    chunks = [ struct.pack("<H", len(names)) ]
+    for name in names:
+        name_bytes = name.encode("utf-8")[:255]
+        chunks.append(struct.pack("<B", len(name_bytes)))
+        chunks.append(name_bytes)
+    return b"".join(chunks)
+
+class TrackingPacketEncoder:
+    """Builds binary tracking packets out of the tracker's HeadState
+    and HandStates.
+
+    With quantize set, packets use FLAG_QUANTIZED, and only every
+    keyframe_interval'th packet is a keyframe. max_error has the
+    largest difference (by section) between what went into the last
+    quantized packet and what the decoder will get out of it.
+    """
+
+    def __init__(self, quantize=False, keyframe_interval=30):
+        self.quantize = quantize
+        self.keyframe_interval = keyframe_interval
+        self.max_error = {}
+        self._poses = numpy.zeros(_pose_value_count, dtype=numpy.float64)
+        self._schema_id = None
+        self._schema_bytes = b""
+
+        # Quantizer state, for delta packets.
+        self._layout = None
+        self._ranges = None
+        self._last_quantized = None
+        self._last_sequence = 0
+        self._packets_since_keyframe = 0
+
+    def force_keyframe(self):
+        """Make the next quantized packet a keyframe."""
+        self._last_quantized = None
+
+    def _get_schema_bytes(self, schema_id, names):
+        if schema_id != self._schema_id:
+            self._schema_bytes = _encode_schema(names)
+            self._schema_id = schema_id
+        return self._schema_bytes
+
+    def _fill_poses(self, head_state, left_hand_state, right_hand_state):
+        poses = self._poses
+        poses[0:3] = head_state.position
+        poses[3:7] = head_state.quat
+        offset = 7
+        for hand_state in [ left_hand_state, right_hand_state ]:
+            poses[offset:offset+3] = hand_state.position
+            poses[offset+3:offset+12] = hand_state.rotation_matrix.ravel()
+            poses[offset+12] = hand_state.position_confidence
+            offset += 13
+        return poses
+
+    def _encode_quantized(self, sequence, values, layout):
+
+        if layout != self._layout:
+            self._layout = layout
+            self._ranges = _get_value_ranges(*layout)
+            self._last_quantized = None
+
+        low, high = self._ranges
+        scale = 65535.0 / (high - low)
+        quantized = numpy.clip(
+            numpy.rint((values - low) * scale), 0, 65535).astype(numpy.int32)
+
+        # Keep track of how far off this is going to be, by section.
+        error = numpy.abs(low + quantized / scale - values)
+        landmark_end = _pose_value_count + (layout[0] + layout[1]) * 3
+        self.max_error = {
+            "poses" : float(error[:_pose_value_count].max()),
+            "landmarks" : float(error[_pose_value_count:landmark_end].max(initial=0.0)),
+            "blendshapes" : float(error[landmark_end:].max(initial=0.0))
+        }
+
+        keyframe = \
+            self._last_quantized is None or \
+            self._packets_since_keyframe + 1 >= self.keyframe_interval
+
+        if keyframe:
+            reference_sequence = sequence
+            body = quantized.astype("<u2").tobytes()
+            self._packets_since_keyframe = 0
+        else:
+            reference_sequence = self._last_sequence
+            differences = quantized - self._last_quantized
+            changed = differences != 0
+            deltas = (differences[changed] + 32768) % 65536 - 32768
+            body = \
+                numpy.packbits(changed, bitorder="little").tobytes() + \
+                deltas.astype("<i2").tobytes()
+            self._packets_since_keyframe += 1
+
+        self._last_quantized = quantized
+        self._last_sequence = sequence
+
+        return keyframe, _reference_struct.pack(reference_sequence) + body
+
+    def encode(
+            self, sequence,
+            capture_time, face_result_time, hands_result_time, send_time,
+            head_state, left_hand_state, right_hand_state,
+            include_schema):
+
+        sequence &= 0xffffffff
+        schema_id, schema_names = head_state.blendshape_schema
+        blendshape_values = head_state.blendshape_values
+
+        left_landmarks = left_hand_state.landmarks[:left_hand_state.landmark_count]
+        right_landmarks = right_hand_state.landmarks[:right_hand_state.landmark_count]
+        poses = self._fill_poses(head_state, left_hand_state, right_hand_state)
+
+        flags = 0
+        if include_schema:
+            flags |= FLAG_BLENDSHAPE_SCHEMA
+
+        if self.quantize:
+            flags |= FLAG_QUANTIZED
+            values = numpy.concatenate([
+                poses, left_landmarks.ravel(), right_landmarks.ravel(),
+                numpy.asarray(blendshape_values, dtype=numpy.float64) ])
+            keyframe, body = self._encode_quantized(
+                sequence, values,
+                (len(left_landmarks), len(right_landmarks), len(blendshape_values)))
+            if keyframe:
+                flags |= FLAG_KEYFRAME
+        else:
+            body = b"".join([
+                poses.astype("<f4").tobytes(),
+                left_landmarks.astype("<f4").tobytes(),
+                right_landmarks.astype("<f4").tobytes(),
+                numpy.array(blendshape_values, dtype="<f4").tobytes() ])
+
+        chunks = [
+            _header_struct.pack(
+                packet_magic, packet_version, flags, sequence,
+                capture_time, face_result_time, hands_result_time, send_time,
+                head_state.missing_time),
+            _counts_struct.pack(
+                len(left_landmarks), len(right_landmarks),
+                schema_id & 0xffff, len(blendshape_values)),
+            body
+        ]
+
+        if include_schema:
+            chunks.append(self._get_schema_bytes(schema_id, schema_names))
+
+        return b"".join(chunks)
+
+class TrackingPacketDecoder:
+    """Python version of the decoder in
+    MediaPipeController_TrackingPacket.gd, for anything other than
+    SnekStudio that wants to read the tracker's output (or a capture of
+    it). decode() gives the same dictionary as the JSON packets would
+    parse into, or None if the packet can't be decoded (yet)."""
+
+    def __init__(self):
+        self._layout = None
+        self._ranges = None
+        self._last_quantized = None
+        self._last_sequence = None
+
+    def decode(self, packet):
+
+        if len(packet) < _header_struct.size + _counts_struct.size:
+            return None
+
+        magic, version, flags, sequence, \
+            capture_time, face_result_time, hands_result_time, send_time, \
+            head_missing_time = _header_struct.unpack_from(packet, 0)
+        if magic != packet_magic or version != packet_version:
+            return None
+
+        offset = _header_struct.size
+        layout = _counts_struct.unpack_from(packet, offset)
+        left_count, right_count, schema_id, blendshape_count = layout
+        layout = (left_count, right_count, blendshape_count)
+        offset += _counts_struct.size
+
+        value_count = \
+            _pose_value_count + (left_count + right_count) * 3 + blendshape_count
+
+        if flags & FLAG_QUANTIZED:
+
+            reference_sequence = _reference_struct.unpack_from(packet, offset)[0]
+            offset += _reference_struct.size
+
+            if layout != self._layout:
+                self._layout = layout
+                self._ranges = _get_value_ranges(*layout)
+                self._last_quantized = None
+
+            if flags & FLAG_KEYFRAME:
+                quantized = numpy.frombuffer(
+                    packet, dtype="<u2", count=value_count,
+                    offset=offset).astype(numpy.int32)
+                offset += value_count * 2
+            else:
+                if self._last_quantized is None or \
+                   reference_sequence != self._last_sequence:
+                    # Missed something. Wait for the next keyframe.
+                    return None
+                mask_size = (value_count + 7) // 8
+                changed = numpy.unpackbits(
+                    numpy.frombuffer(packet, dtype=numpy.uint8,
+                                     count=mask_size, offset=offset),
+                    count=value_count, bitorder="little").astype(bool)
+                offset += mask_size
+                change_count = int(changed.sum())
+                deltas = numpy.frombuffer(
+                    packet, dtype="<i2", count=change_count, offset=offset)
+                offset += change_count * 2
+                quantized = self._last_quantized.copy()
+                quantized[changed] = (quantized[changed] + deltas) % 65536
+
+            self._last_quantized = quantized
+            self._last_sequence = sequence
+
+            low, high = self._ranges
+            values = low + quantized * ((high - low) / 65535.0)
+
+        else:
+            values = numpy.frombuffer(
+                packet, dtype="<f4", count=value_count,
+                offset=offset).astype(numpy.float64)
+            offset += value_count * 4
+
+        output = {
+            "sequence" : sequence,
+            "capture_time" : capture_time,
+            "face_result_time" : face_result_time,
+            "hands_result_time" : hands_result_time,
+            "send_time" : send_time,
+            "head_missing_time" : head_missing_time,
+            "head_origin" : values[0:3].tolist(),
+            "head_quat" : values[3:7].tolist(),
+            "blendshape_schema_id" : schema_id
+        }
+
+        index = 7
+        for side in [ "left", "right" ]:
+            output["hand_%s_origin" % side] = values[index:index+3].tolist()
+            output["hand_%s_rotation" % side] = \
+                values[index+3:index+12].reshape(3, 3).tolist()
+            output["hand_%s_score" % side] = float(values[index+12])
+            index += 13
+
+        for side, count in [ ("left", left_count), ("right", right_count) ]:
+            output["hand_landmarks_%s" % side] = \
+                values[index:index+count*3].reshape(count, 3).tolist()
+            index += count * 3
+
+        output["blendshape_values"] = values[index:].tolist()
+
+        if flags & FLAG_BLENDSHAPE_SCHEMA:
+            name_count = struct.unpack_from("<H", packet, offset)[0]
+            offset += 2
+            names = []
+            for _ in range(name_count):
+                name_length = packet[offset]
+                offset += 1
+                names.append(bytes(packet[offset:offset+name_length]).decode("utf-8"))
+                offset += name_length
+            output["blendshape_schema"] = {
+                "id" : schema_id,
+                "names" : names
+            }
+
+        return output
+
+def get_reconstruction_error(decoded, reference):
+    """Largest difference between each numeric field of two decoded
+    packets (or JSON packets). Use it to see how much a quantized
+    packet lost compared to the float version of the same data."""
+
+    error = {}
+    for key, value in reference.items():
+        if key in decoded and key not in [ "sequence", "send_time", "blendshape_schema" ]:
+            a = numpy.asarray(decoded[key], dtype=numpy.float64)
+            b = numpy.asarray(value, dtype=numpy.float64)
+            if a.shape == b.shape:
+                error[key] = float(numpy.abs(a - b).max(initial=0.0))
+    return error
@@ -0,0 +1,130 @@
+#!/usr/bin/python3
+
+# Frame sources for running the tracker on recorded video instead of
+# a live camera. Useful for benchmarking on machines with no webcam,
+# and for re-processing old sessions.
+#
+# These stand in for cv2.VideoCapture as far as the capture thread is
+# concerned, but also know where each frame is in the recording, so
+# timestamps come from the media instead of the wall clock.
+
+import os
+import time
+
+import cv2
+
+class ImageSequenceCapture:
+    """Reads a directory full of images, in filename order, like it's
+    a video. Only the parts of the cv2.VideoCapture interface that the
+    tracker uses are here."""
+
+    image_extensions = [
+        ".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff", ".webp" ]
+
+    def __init__(self, directory):
+        self._paths = []
+        if os.path.isdir(directory):
+            for filename in sorted(os.listdir(directory)):
+                if os.path.splitext(filename)[1].lower() in self.image_extensions:
+                    self._paths.append(os.path.join(directory, filename))
+        self._next_index = 0
+
+    def isOpened(self):
+        return len(self._paths) > 0
+
+    def set(self, prop, value):
+        # Nothing to configure. Images are whatever size they are.
+        return False
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FRAME_COUNT:
+            return float(len(self._paths))
+        return 0.0
+
+    def grab(self):
+        if self._next_index >= len(self._paths):
+            return False
+        self._next_index += 1
+        return True
+
+    def read(self, image=None):
+        if self._next_index >= len(self._paths):
+            return False, None
+        path = self._paths[self._next_index]
+        self._next_index += 1
+
+        # FIXME: imread can't write into an existing buffer, so this
+        # allocates every frame. Fine for offline use.
+        new_image = cv2.imread(path, cv2.IMREAD_COLOR)
+        if new_image is None:
+            return False, None
+        return True, new_image
+
+class ReplayCapture:
+    """A video file or image directory to run the tracker on.
+
+    Frames come out with capture times of start_time plus their
+    position in the recording. If real_time is set, read() waits
+    until that time comes around, so the recording plays back at its
+    original speed. Otherwise frames come out as fast as they can be
+    decoded.
+
+    fps is only used when the source doesn't know its own frame rate
+    (image directories, and some video files).
+    """
+
+    def __init__(self, path, start_time, real_time=False, fps=30.0):
+
+        if os.path.isdir(path):
+            self._capture = ImageSequenceCapture(path)
+        else:
+            self._capture = cv2.VideoCapture(path)
+
+        source_fps = self._capture.get(cv2.CAP_PROP_FPS)
+        if source_fps and source_fps > 0.0:
+            fps = source_fps
+
+        self.path = path
+        self.fps = fps
+        self.real_time = real_time
+        self.start_time = start_time
+        self.frames_read = 0
+        self.finished = False
+
+        # Wall clock time we started, for measuring throughput.
+        self.open_time = time.time()
+
+    def isOpened(self):
+        return self._capture.isOpened()
+
+    def set(self, prop, value):
+        return self._capture.set(prop, value)
+
+    def get(self, prop):
+        return self._capture.get(prop)
+
+    def get_next_frame_time(self):
+        return self.start_time + self.frames_read / self.fps
+
+    def read(self, image=None):
+        """Returns (success, image, capture_time). Sets finished once
+        the recording runs out."""
+
+        capture_time = self.get_next_frame_time()
+
+        if self.real_time:
+            time_to_sleep = capture_time - time.time()
+            if time_to_sleep > 0.0:
+                time.sleep(time_to_sleep)
+
+        success, image = self._capture.read(image)
+        if not success:
+            self.finished = True
+            return False, None, capture_time
+
+        self.frames_read += 1
+        return True, image, capture_time
+
+    def release(self):
+        if hasattr(self._capture, "release"):
+            self._capture.release()
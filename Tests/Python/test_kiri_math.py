@@ -0,0 +1,144 @@
+#!/usr/bin/python3
+
+# Checks that the batched functions in kiri_math (xform_many(),
+# quaternions_to_matrices(), etc) give the same answers as the
+# one-at-a-time versions they're based on.
+#
+# Run with: python -m pytest Tests/Python
+
+import math
+import os
+import sys
+
+import numpy
+
+sys.path.append(os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "..", "..", "Mods", "MediaPipe", "_tracker", "Project"))
+
+import kiri_math
+
+# Same math in the same order, so these should be nearly exact.
+tolerance = 1e-12
+
+def _random_quaternions(rng, count):
+    quats = rng.normal(size=(count, 4))
+    return quats / numpy.linalg.norm(quats, axis=1)[:, None]
+
+def _random_rotation_matrices(rng, count):
+    return numpy.array([
+        kiri_math.quaternion_to_matrix(quat)
+        for quat in _random_quaternions(rng, count) ])
+
+def test_xform_many():
+    rng = numpy.random.default_rng(1)
+
+    matrix = rng.normal(size=(4, 4))
+    matrix[3] = [ 0.1, 0.2, 0.3, 5.0 ]
+
+    for width in [ 3, 4 ]:
+        vecs = rng.normal(size=(100, width))
+        expected = numpy.array([ kiri_math.xform(matrix, vec) for vec in vecs ])
+        numpy.testing.assert_allclose(
+            kiri_math.xform_many(matrix, vecs), expected,
+            rtol=tolerance, atol=tolerance)
+
+def test_quaternions_to_matrices():
+    rng = numpy.random.default_rng(2)
+
+    quats = numpy.concatenate([
+        _random_quaternions(rng, 100),
+
+        # Identity, 180 degree turns, and a non-unit one.
+        [ [ 0.0, 0.0, 0.0, 1.0 ],
+          [ 1.0, 0.0, 0.0, 0.0 ],
+          [ 0.0, 1.0, 0.0, 0.0 ],
+          [ 0.0, 0.0, 1.0, 0.0 ],
+          [ 0.5, -1.0, 2.0, 0.25 ] ] ])
+
+    expected = numpy.array([ kiri_math.quaternion_to_matrix(quat) for quat in quats ])
+    numpy.testing.assert_allclose(
+        kiri_math.quaternions_to_matrices(quats), expected,
+        rtol=tolerance, atol=tolerance)
+
+def test_matrices_to_quaternions():
+    rng = numpy.random.default_rng(3)
+
+    mats = list(_random_rotation_matrices(rng, 100))
+
+    # Things where 1 - m00 + m11 + m22 <= 0, which the single version
+    # gives up on and returns identity for.
+    mats.append(numpy.diag([ 1.0, -1.0, -1.0 ])) # Exactly zero
+    mats.append(numpy.diag([ 1.0, -1.0, 1.0 ]))  # Exactly zero too
+    mats.append(numpy.diag([ 2.0, -1.0, -1.0 ])) # Negative
+    mats.append(numpy.eye(3))
+
+    mats = numpy.array(mats)
+    assert (1.0 - mats[:, 0, 0] + mats[:, 1, 1] + mats[:, 2, 2] <= 0.0).any()
+
+    expected = numpy.array([ kiri_math.matrix_to_quaternion(mat) for mat in mats ])
+    batched = kiri_math.matrices_to_quaternions(mats)
+    numpy.testing.assert_allclose(batched, expected, rtol=tolerance, atol=tolerance)
+
+    for index in [ -4, -3, -2 ]:
+        numpy.testing.assert_array_equal(batched[index], [ 0.0, 0.0, 0.0, 1.0 ])
+
+def test_matrices_to_quaternions_4x4():
+    rng = numpy.random.default_rng(4)
+
+    mats = _random_rotation_matrices(rng, 20)
+    transforms = numpy.zeros((20, 4, 4))
+    transforms[:, 0:3, 0:3] = mats
+    transforms[:, 0:3, 3] = rng.normal(size=(20, 3))
+    transforms[:, 3, 3] = 1.0
+
+    numpy.testing.assert_allclose(
+        kiri_math.matrices_to_quaternions(transforms),
+        kiri_math.matrices_to_quaternions(mats),
+        rtol=tolerance, atol=tolerance)
+
+def test_quaternions_to_eulers():
+    rng = numpy.random.default_rng(5)
+
+    half_sqrt2 = math.sqrt(0.5)
+
+    quats = numpy.concatenate([
+        _random_quaternions(rng, 100),
+
+        # Gimbal lock (pitch of exactly +/-90 degrees), and a bit past
+        # it from a non-unit quaternion, which hits the clamp.
+        [ [ 0.0, half_sqrt2, 0.0, half_sqrt2 ],
+          [ 0.0, -half_sqrt2, 0.0, half_sqrt2 ],
+          [ 0.5, 0.5, -0.5, 0.5 ],
+          [ 0.0, 0.8, 0.0, 0.8 ],
+          [ 0.0, 0.0, 0.0, 1.0 ] ] ])
+
+    expected = numpy.array([ kiri_math.quaternion_to_euler(quat) for quat in quats ])
+    numpy.testing.assert_allclose(
+        kiri_math.quaternions_to_eulers(quats), expected,
+        rtol=tolerance, atol=tolerance)
+
+def test_eulers_to_quaternions():
+    rng = numpy.random.default_rng(6)
+
+    eulers = numpy.concatenate([
+        rng.uniform(-math.pi, math.pi, size=(100, 3)),
+
+        # Gimbal lock.
+        [ [ 0.3, math.pi / 2, -0.7 ],
+          [ -1.0, -math.pi / 2, 2.0 ],
+          [ 0.0, 0.0, 0.0 ] ] ])
+
+    expected = numpy.array([ kiri_math.euler_to_quaternion(euler) for euler in eulers ])
+    numpy.testing.assert_allclose(
+        kiri_math.eulers_to_quaternions(eulers), expected,
+        rtol=tolerance, atol=tolerance)
+
+def test_empty():
+    assert kiri_math.xform_many(numpy.eye(4), numpy.empty((0, 3))).shape == (0, 3)
+    assert kiri_math.xform_many(numpy.eye(4), numpy.empty((0, 4))).shape == (0, 4)
+    assert kiri_math.quaternions_to_matrices(numpy.empty((0, 4))).shape == (0, 3, 3)
+    assert kiri_math.matrices_to_quaternions(numpy.empty((0, 3, 3))).shape == (0, 4)
+    assert kiri_math.matrices_to_quaternions(numpy.empty((0, 4, 4))).shape == (0, 4)
+    assert kiri_math.quaternions_to_eulers(numpy.empty((0, 4))).shape == (0, 3)
+    assert kiri_math.eulers_to_quaternions(numpy.empty((0, 3))).shape == (0, 4)
@@ -0,0 +1,269 @@
+#!/usr/bin/python3
+
+# Checks that the threaded PacketSocket and the asyncio
+# AsyncPacketSocket can talk to each other, since either end of a
+# connection might be either one.
+#
+# Run with: python -m pytest Tests/Python
+
+import asyncio
+import os
+import random
+import socket
+import sys
+import threading
+import time
+
+sys.path.append(os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "..", "..", "addons", "KiriPythonRPCWrapper", "KiriPythonRPCWrapper"))
+
+import KiriPacketSocket
+from KiriPacketSocket import async_packet_socket
+
+PacketSocket = KiriPacketSocket.PacketSocket
+
+# Generous, so a slow machine doesn't fail the tests. Nothing should
+# actually take this long.
+timeout = 10.0
+
+def _make_packets():
+    rng = random.Random(1)
+    packets = [ rng.randbytes(rng.choice([ 1, 3, 100, 1000, 70000 ])) for _ in range(50) ]
+
+    # Bigger than any of the socket or receive buffers.
+    packets.append(rng.randbytes(5000000))
+    packets.append(b'after the big one')
+    return packets
+
+def _frame(packets):
+    return b''.join(len(packet).to_bytes(4, "little") + packet for packet in packets)
+
+def _get_free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def _start_threaded_server():
+    server = PacketSocket()
+    port = _get_free_port()
+    server.start_server(("127.0.0.1", port))
+
+    end_time = time.time() + timeout
+    while server.get_state() != PacketSocket.SocketState.SERVER_LISTENING:
+        assert server.get_state() != PacketSocket.SocketState.ERROR, server.get_last_error()
+        assert time.time() < end_time
+        time.sleep(0.001)
+
+    return server, port
+
+def _send_in_pieces(sock, data):
+    """Send data in small random pieces, with pauses, so the other end
+    has to put packets back together across reads."""
+    rng = random.Random(2)
+    offset = 0
+    while offset < len(data):
+        piece_size = rng.choice([ 1, 2, 3, 5, 7, 1000 ])
+        sock.sendall(data[offset:offset + piece_size])
+        offset += piece_size
+        time.sleep(0.0005)
+
+def test_threaded_client_async_server():
+
+    packets = _make_packets()
+
+    async def run():
+
+        disconnected = asyncio.Event()
+
+        async def echo(connection):
+            async for packet in connection:
+                await connection.send_packet(packet)
+            disconnected.set()
+
+        server = await async_packet_socket.start_server(("127.0.0.1", 0), echo)
+        port = server.sockets[0].getsockname()[1]
+
+        def threaded_client():
+            client = PacketSocket()
+            client.start_client(("127.0.0.1", port))
+            try:
+                for packet in packets:
+                    client.send_packet(packet)
+                for packet in packets:
+                    assert client.wait_for_packet(timeout) == packet
+            finally:
+                client.stop()
+
+        await asyncio.to_thread(threaded_client)
+
+        # Client hanging up ends the server's async for.
+        await asyncio.wait_for(disconnected.wait(), timeout)
+
+        server.close()
+        await server.wait_closed()
+
+    asyncio.run(run())
+
+def test_async_client_threaded_server():
+
+    packets = _make_packets()
+    server, port = _start_threaded_server()
+    server_connection = None
+
+    try:
+
+        async def run():
+            nonlocal server_connection
+
+            client = await async_packet_socket.AsyncPacketSocket.connect(("127.0.0.1", port))
+
+            server_connection = await asyncio.to_thread(
+                server.wait_for_connection, timeout)
+            assert server_connection is not None
+
+            # Send everything first, while the server end is echoing
+            # back, so both directions are busy at once.
+            def threaded_echo():
+                for _ in packets:
+                    packet = server_connection.wait_for_packet(timeout)
+                    assert packet is not None
+                    server_connection.send_packet(packet)
+
+            echo_task = asyncio.create_task(asyncio.to_thread(threaded_echo))
+
+            for packet in packets:
+                await client.send_packet(packet)
+            for packet in packets:
+                assert await asyncio.wait_for(client.recv_packet(), timeout) == packet
+
+            await echo_task
+            await client.close()
+
+        asyncio.run(run())
+
+        # The threaded end notices the disconnect.
+        assert server_connection.wait_for_packet(timeout) is None
+        assert server_connection.get_state() == PacketSocket.SocketState.DISCONNECTED
+
+    finally:
+        if server_connection is not None:
+            server_connection.stop()
+        server.stop()
+
+def test_async_server_split_reads():
+
+    packets = _make_packets()[:-2]
+
+    async def run():
+
+        received = []
+        disconnected = asyncio.Event()
+
+        async def collect(connection):
+            async for packet in connection:
+                received.append(packet)
+            disconnected.set()
+
+        server = await async_packet_socket.start_server(("127.0.0.1", 0), collect)
+        port = server.sockets[0].getsockname()[1]
+
+        def raw_client():
+            with socket.create_connection(("127.0.0.1", port)) as sock:
+                _send_in_pieces(sock, _frame(packets))
+
+        await asyncio.to_thread(raw_client)
+        await asyncio.wait_for(disconnected.wait(), timeout)
+        assert received == packets
+
+        server.close()
+        await server.wait_closed()
+
+    asyncio.run(run())
+
+def test_threaded_server_split_reads():
+
+    packets = _make_packets()[:-2]
+    server, port = _start_threaded_server()
+    server_connection = None
+
+    try:
+        with socket.create_connection(("127.0.0.1", port)) as sock:
+            server_connection = server.wait_for_connection(timeout)
+            assert server_connection is not None
+            _send_in_pieces(sock, _frame(packets))
+
+        for packet in packets:
+            assert server_connection.wait_for_packet(timeout) == packet
+        assert server_connection.wait_for_packet(timeout) is None
+
+    finally:
+        if server_connection is not None:
+            server_connection.stop()
+        server.stop()
+
+def test_async_disconnect_mid_packet():
+
+    async def run():
+
+        received = []
+        disconnected = asyncio.Event()
+
+        async def collect(connection):
+            while True:
+                packet = await connection.recv_packet()
+                received.append(packet)
+                if packet is None:
+                    break
+            disconnected.set()
+
+        server = await async_packet_socket.start_server(("127.0.0.1", 0), collect)
+        port = server.sockets[0].getsockname()[1]
+
+        def raw_client():
+            with socket.create_connection(("127.0.0.1", port)) as sock:
+                # One whole packet, then half of another.
+                sock.sendall(_frame([ b'whole' ]))
+                sock.sendall((100).to_bytes(4, "little") + b'partial')
+
+        await asyncio.to_thread(raw_client)
+        await asyncio.wait_for(disconnected.wait(), timeout)
+        assert received == [ b'whole', None ]
+
+        server.close()
+        await server.wait_closed()
+
+    asyncio.run(run())
+
+def test_threaded_disconnect_wakes_waiter():
+
+    server, port = _start_threaded_server()
+    server_connection = None
+
+    try:
+
+        async def run():
+            nonlocal server_connection
+            client = await async_packet_socket.AsyncPacketSocket.connect(("127.0.0.1", port))
+            server_connection = await asyncio.to_thread(
+                server.wait_for_connection, timeout)
+            assert server_connection is not None
+
+            # Something's already waiting when the client goes away.
+            waiter = asyncio.create_task(asyncio.to_thread(
+                server_connection.wait_for_packet, timeout))
+            await asyncio.sleep(0.05)
+            await client.close()
+
+            start_time = time.time()
+            assert await waiter is None
+            assert time.time() - start_time < timeout / 2
+
+        asyncio.run(run())
+
+        assert server_connection.is_disconnected_or_error()
+
+    finally:
+        if server_connection is not None:
+            server_connection.stop()
+        server.stop()
@@ -23,6 +23,9 @@
 # SOFTWARE.
 
 import socket
+import selectors
+import collections
+import itertools
 import threading
 import time
 import sys
@@ -51,12 +54,19 @@ class PacketSocket:
       PacketSocket that can actually receive packets, otherwise).
       Polling interface.
 
+    - wait_for_connection(timeout) - Like get_next_server_connection(),
+      but waits up to timeout seconds (or forever, if None) for one.
+
     - send_packet(b) - Sends a byte array (b) as a packet. This adds
       it to a queue which is send in its own thread.
 
     - get_next_packet() - Gets the next complete incoming packet as a
       byte array or None if no packet yet (polling interface).
 
+    - wait_for_packet(timeout) - Like get_next_packet(), but waits up
+      to timeout seconds (or forever, if None) for one to arrive.
+      Returns None on timeout or if the connection goes away.
+
     - get_last_error() - Gets the last error as a string.
 
     - is_disconnected_or_error() - True if we've had a problem (use
@@ -98,29 +108,89 @@ class PacketSocket:
     class PacketBuffer:
         """Receiving buffer for packets. Accumulates bytes until
         complete packets are formed.
+
+        Incoming data goes straight into a bytearray (with
+        receive_from()), and we walk through it with a read offset
+        instead of re-slicing the remaining data after every packet.
+        Whatever's left over gets moved back to the start only when we
+        need the room.
+
         """
 
+        # Smallest amount of free space we'll hand to recv_into(), so
+        # that we're not doing tiny reads.
+        minimum_read_size = 65536
+
         def __init__(self):
-            self._receive_buffer = b''
-            self._packet_buffer = []
+            self._receive_buffer = bytearray(self.minimum_read_size)
+            self._read_offset = 0
+            self._write_offset = 0
+            self._packet_buffer = collections.deque()
 
         def _grab_complete_packets(self):
 
-            while len(self._receive_buffer) >= 4:
+            # Slicing the memoryview doesn't copy, so each packet only
+            # gets copied once (into its own bytes). All the views have
+            # to be released before _make_room() can resize the buffer,
+            # hence the "with"s.
+            with memoryview(self._receive_buffer) as view:
 
-                next_packet_size = int.from_bytes(
-                    self._receive_buffer[0:4],
-                    "little")
+                while self._write_offset - self._read_offset >= 4:
 
-                if len(self._receive_buffer) >= 4 + next_packet_size:
+                    next_packet_size = int.from_bytes(
+                        view[self._read_offset : self._read_offset + 4],
+                        "little")
 
-                    next_packet = self._receive_buffer[4 : 4 + next_packet_size]
-                    self._receive_buffer = self._receive_buffer[4 + len(next_packet):]
-                    self._packet_buffer.append(next_packet)
+                    packet_start = self._read_offset + 4
+                    packet_end = packet_start + next_packet_size
 
-                else:
+                    if packet_end <= self._write_offset:
 
-                    break
+                        with view[packet_start : packet_end] as packet_view:
+                            self._packet_buffer.append(bytes(packet_view))
+                        self._read_offset = packet_end
+
+                    else:
+
+                        break
+
+            # Everything's been read, so we can start from the
+            # beginning again for free.
+            if self._read_offset == self._write_offset:
+                self._read_offset = 0
+                self._write_offset = 0
+
+        def _make_room(self):
+            """Make sure there's enough free space after the write
+            offset for the next read. If we know how big the next
+            packet is, make room for all of it."""
+
+            needed_size = self.minimum_read_size
+            pending_size = self._write_offset - self._read_offset
+
+            if pending_size >= 4:
+                next_packet_size = int.from_bytes(
+                    self._receive_buffer[self._read_offset : self._read_offset + 4],
+                    "little")
+                needed_size = max(needed_size, 4 + next_packet_size - pending_size)
+
+            if len(self._receive_buffer) - self._write_offset >= needed_size:
+                return
+
+            # Compact. Move the partial packet down to the start.
+            if self._read_offset:
+                self._receive_buffer[0 : pending_size] = \
+                    self._receive_buffer[self._read_offset : self._write_offset]
+                self._read_offset = 0
+                self._write_offset = pending_size
+
+            # Grow, if that wasn't enough.
+            if len(self._receive_buffer) - self._write_offset < needed_size:
+                new_size = max(
+                    len(self._receive_buffer) * 2,
+                    self._write_offset + needed_size)
+                self._receive_buffer.extend(
+                    bytes(new_size - len(self._receive_buffer)))
 
         def _have_complete_packet(self):
             self._grab_complete_packets()
@@ -129,10 +199,29 @@ class PacketSocket:
         def get_next_packet(self):
             if not self._have_complete_packet():
                 return None
-            return self._packet_buffer.pop(0)
+            return self._packet_buffer.popleft()
 
         def add_bytes(self, incoming_bytes):
-            self._receive_buffer += incoming_bytes
+            self._make_room()
+            # _make_room() only guarantees minimum_read_size.
+            end = self._write_offset + len(incoming_bytes)
+            self._receive_buffer[self._write_offset : end] = incoming_bytes
+            self._write_offset = end
+
+        def receive_from(self, sock):
+            """recv_into() directly from a socket. Returns the number of
+            bytes received (0 means the other end hung up)."""
+
+            self._make_room()
+
+            # The memoryviews need to be released before the
+            # bytearray can be resized again.
+            with memoryview(self._receive_buffer) as view:
+                with view[self._write_offset:] as free_space:
+                    received = sock.recv_into(free_space)
+
+            self._write_offset += received
+            return received
 
     class SocketState(enum.Enum):
         DISCONNECTED     = 0
@@ -146,14 +235,28 @@ class PacketSocket:
         self._should_quit = False
         self._packet_buffer = self.PacketBuffer()
         self._state = self.SocketState.DISCONNECTED
-        self._outgoing_packet_queue = []
+        self._outgoing_packet_queue = collections.deque()
+
+        # Packets that the communication loop has taken off the queue
+        # but hasn't finished sending yet.
+        self._sending_packet_count = 0
 
         self._state_lock = threading.Lock()
         self._worker_thread = None
 
+        # Shares _state_lock. Notified whenever packets or
+        # connections come in, or the state changes, so the wait_for_*
+        # functions can wake up.
+        self._state_condition = threading.Condition(self._state_lock)
+
         self._new_connections_to_server = []
         self._error_string = None
 
+        # Write end of the socketpair that wakes up the communication
+        # loop when there's something to send (or we need to quit).
+        # Only exists while the loop is running.
+        self._wakeup_socket = None
+
     def __del__(self):
         # WE BETTER NOT HAVE ZOMBIE THREADS SITTING AROUND.
         assert(not self._worker_thread)
@@ -165,6 +268,7 @@ class PacketSocket:
 
             assert(packet_bytes)
             self._outgoing_packet_queue.append(packet_bytes)
+            self._wake_up()
 
     def get_next_packet(self):
         """Get a binary blob from the receive queue."""
@@ -173,10 +277,31 @@ class PacketSocket:
 
         return ret
 
+    def wait_for_packet(self, timeout=None):
+        """Get a binary blob from the receive queue, waiting up to
+        timeout seconds (forever if None) for one to show up.
+
+        Returns None if we timed out, or if the connection is gone
+        (disconnected or error) and there's nothing left in the queue.
+
+        """
+
+        bad_states = [
+            self.SocketState.DISCONNECTED,
+            self.SocketState.ERROR
+        ]
+
+        with self._state_condition:
+            self._state_condition.wait_for(
+                lambda: self._packet_buffer._have_complete_packet() or \
+                    self._state in bad_states,
+                timeout)
+            return self._packet_buffer.get_next_packet()
+
     def get_send_queue_size(self):
         """Get the number of things waiting to send."""
         with self._state_lock:
-            ret = len(self._outgoing_packet_queue)
+            ret = len(self._outgoing_packet_queue) + self._sending_packet_count
 
         return ret
 
@@ -192,6 +317,24 @@ class PacketSocket:
                 ret = self._new_connections_to_server.pop(0)
         return ret
 
+    def wait_for_connection(self, timeout=None):
+        """For servers: Get the next incoming connection as a
+        PacketSocket instance, waiting up to timeout seconds (forever
+        if None) for one.
+
+        Returns None if we timed out or the server had an error.
+
+        """
+        with self._state_condition:
+            self._state_condition.wait_for(
+                lambda: len(self._new_connections_to_server) or \
+                    self._state == self.SocketState.ERROR,
+                timeout)
+            ret = None
+            if len(self._new_connections_to_server):
+                ret = self._new_connections_to_server.pop(0)
+        return ret
+
     def get_last_error(self):
         """Get the last error, as a string. (From the thrown exception.)
 
@@ -276,6 +419,8 @@ class PacketSocket:
 
         assert(self._worker_thread)
         self._should_quit = True
+        with self._state_lock:
+            self._wake_up()
         self._worker_thread.join()
         self._worker_thread = None
         self._should_quit = False
@@ -283,32 +428,188 @@ class PacketSocket:
     def is_running(self):
         return not (self._worker_thread == None)
 
-    def _normal_communication_loop(self, sock, address):
-        """Shared communication loop between clients and servers."""
+    def _wake_up(self):
+        """Kick the communication loop out of its wait. Call with
+        _state_lock held."""
 
-        # Packet wranging timeout. Should be low so we can send and
-        # receive packets fast.
-        sock.settimeout(0.0001)
+        if self._wakeup_socket:
+            try:
+                self._wakeup_socket.send(b'\x00')
+            except (BlockingIOError, OSError):
+                # Buffer's full of wakeups already, or the loop is
+                # shutting down. Either way, nothing to do.
+                pass
 
-        while not self._should_quit:
+    # Most buffers we'll hand to a single sendmsg() call. Needs to
+    # stay under the OS's IOV_MAX (1024 on Linux and macOS).
+    _max_send_buffers = 512
+
+    # Without sendmsg(), this is about how much we'll glue together
+    # into one buffer for a single send() instead.
+    _max_joined_send_size = 262144
+
+    def _join_buffers(self, views):
+        """No scatter-gather on Windows. Glue the first however many
+        views will fit in _max_joined_send_size together, so they
+        still go out in one send(). (A single view that's bigger than
+        that goes by itself, uncopied.)"""
+
+        if len(views) == 1:
+            return views[0]
+
+        joined_views = []
+        joined_size = 0
+        for view in views:
+            if joined_views and joined_size + len(view) > self._max_joined_send_size:
+                break
+            joined_views.append(view)
+            joined_size += len(view)
+
+        if len(joined_views) == 1:
+            return joined_views[0]
+
+        return b''.join(joined_views)
+
+    def _send_buffers(self, sock, views):
+        """Write out as much of a deque of memoryviews as the socket
+        will take right now, in as few syscalls as we can manage.
+        Whatever went out gets removed (or trimmed, for short writes),
+        so the next call picks up where this one left off."""
+
+        while views:
 
-            # Get new data.
             try:
-                incoming_bytes = sock.recv(1024)
-                if not incoming_bytes:
-                    break
+                if hasattr(sock, "sendmsg"):
+                    sent = sock.sendmsg(
+                        list(itertools.islice(views, self._max_send_buffers)))
+                else:
+                    sent = sock.send(self._join_buffers(views))
+            except BlockingIOError:
+                # Socket's full. Wait until it's writable again.
+                return
+
+            # Drop everything that went out completely, and trim
+            # whatever only went out partially.
+            while sent:
+                if sent >= len(views[0]):
+                    sent -= len(views[0])
+                    views.popleft()
+                else:
+                    views[0] = views[0][sent:]
+                    sent = 0
+
+    def _normal_communication_loop(self, sock, address):
+        """Shared communication loop between clients and servers.
+
+        Sleeps until either the socket has something for us (or room
+        for what we're trying to send), or send_packet()/stop() pokes
+        the wakeup socket.
+
+        """
+
+        # Non-blocking, so that a big send can't stop us from reading.
+        # Otherwise, if both ends are sending more than the socket
+        # buffers hold, neither one ever gets around to receiving.
+        sock.setblocking(False)
+
+        # We already batch up everything that's queued into one write,
+        # so Nagle's algorithm would only add latency (especially
+        # waiting on delayed ACKs for small RPC calls).
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        wakeup_receiver, wakeup_sender = socket.socketpair()
+        wakeup_receiver.setblocking(False)
+        wakeup_sender.setblocking(False)
+
+        selector = selectors.DefaultSelector()
+        selector.register(sock, selectors.EVENT_READ, "socket")
+        selector.register(wakeup_receiver, selectors.EVENT_READ, "wakeup")
+        socket_events = selectors.EVENT_READ
+
+        # Sizes and packets that haven't made it out yet, as
+        # memoryviews.
+        outgoing_views = collections.deque()
+
+        with self._state_lock:
+            self._wakeup_socket = wakeup_sender
+
+        try:
+
+            while not self._should_quit:
+
+                # Grab everything from the queue, so that
+                # send_packet() doesn't have to wait on the network.
                 with self._state_lock:
-                    self._packet_buffer.add_bytes(incoming_bytes)
-            except TimeoutError:
-                pass
+                    outgoing_packets = self._outgoing_packet_queue
+                    self._outgoing_packet_queue = collections.deque()
+                    self._sending_packet_count += len(outgoing_packets)
+
+                if outgoing_packets:
+
+                    outgoing_buffers = []
+                    for next_outgoing_packet in outgoing_packets:
+                        outgoing_buffers.append(
+                            len(next_outgoing_packet).to_bytes(4, "little"))
+                        outgoing_buffers.append(next_outgoing_packet)
+
+                    outgoing_views.extend(
+                        memoryview(buffer) for buffer in outgoing_buffers)
+
+                # Sizes and packets all go out in one write, if the
+                # socket has room.
+                if outgoing_views:
+                    self._send_buffers(sock, outgoing_views)
+                    if not outgoing_views:
+                        with self._state_lock:
+                            self._sending_packet_count = 0
+
+                # Only ask about writability when we're stuck on it,
+                # or we'd never sleep.
+                wanted_events = selectors.EVENT_READ
+                if outgoing_views:
+                    wanted_events |= selectors.EVENT_WRITE
+                if wanted_events != socket_events:
+                    selector.modify(sock, wanted_events, "socket")
+                    socket_events = wanted_events
+
+                # Wait for something to happen. No timeout needed,
+                # because stop() wakes us up too.
+                for key, events in selector.select():
+
+                    if key.data == "wakeup":
+
+                        # Drain the wakeups. We've already dealt with
+                        # whatever caused them, or will at the top of
+                        # the loop.
+                        try:
+                            while wakeup_receiver.recv(1024):
+                                pass
+                        except BlockingIOError:
+                            pass
+
+                    elif events & selectors.EVENT_READ:
+
+                        # Get new data.
+                        try:
+                            with self._state_lock:
+                                received = self._packet_buffer.receive_from(sock)
+                                self._state_condition.notify_all()
+                        except BlockingIOError:
+                            continue
+                        if not received:
+                            return
+
+                    # Writable just means we go around again and send
+                    # some more.
+
+        finally:
 
-            # Send all packets from queue.
             with self._state_lock:
+                self._wakeup_socket = None
 
-                while len(self._outgoing_packet_queue):
-                    next_outgoing_packet = self._outgoing_packet_queue.pop(0)
-                    sock.send(len(next_outgoing_packet).to_bytes(4, "little"))
-                    sock.send(next_outgoing_packet)
+            selector.close()
+            wakeup_receiver.close()
+            wakeup_sender.close()
 
     def _client_thread_func(self, address):
         """Client startup thread function. Attempts to establishes connection."""
@@ -343,6 +644,8 @@ class PacketSocket:
                 assert(not error_string)
                 self._error_string = None
 
+            self._state_condition.notify_all()
+
 
     def _server_to_client_thread_func(self, connection, address):
         """Server connection startup thread function. Initiated
@@ -407,6 +710,7 @@ class PacketSocket:
 
                         with self._state_lock:
                             self._new_connections_to_server.append(new_client)
+                            self._state_condition.notify_all()
 
                     except TimeoutError:
                         pass
@@ -0,0 +1,152 @@
+#!/usr/bin/python3
+
+# Copyright © 2024 Kiri Jolly
+
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the “Software”), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# asyncio version of PacketSocket, for Python modules that want to do
+# a bunch of I/O at once from a single thread instead of having a
+# thread per connection.
+#
+# Same packet format as PacketSocket (and KiriPacketSocket.gd), so
+# either end can be either implementation. See the PacketSocket
+# docstring in __init__.py for the details.
+#
+# Kept in its own module so that the regular PacketSocket doesn't
+# have to import asyncio.
+
+import asyncio
+import socket
+
+class AsyncPacketSocket:
+    """A connection that sends and receives packets. Get one from
+    connect(), or from start_server()'s callback.
+
+    Main public API:
+
+    - await AsyncPacketSocket.connect(address) - Connect to an open
+      port.
+
+    - await send_packet(b) - Sends a byte array (b) as a packet. Waits
+      if the other end isn't keeping up.
+
+    - await recv_packet() - Waits for the next complete incoming packet
+      and returns it as a byte array, or returns None if the
+      connection is gone.
+
+    - async for packet in packet_socket - Same as calling recv_packet()
+      until it returns None.
+
+    - await close() - Disconnect.
+
+    """
+
+    def __init__(self, reader, writer):
+        self._reader = reader
+        self._writer = writer
+
+        # Same as PacketSocket. We write whole packets at once, so
+        # Nagle's algorithm would only add latency.
+        sock = writer.get_extra_info("socket")
+        if sock is not None and sock.family in (socket.AF_INET, socket.AF_INET6):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    @classmethod
+    async def connect(cls, address):
+        """Connect to a listening server (like PacketSocket.start_client).
+
+        Address is a tuple with a host IP (string) and a port number
+        (int).
+
+        """
+        reader, writer = await asyncio.open_connection(address[0], address[1])
+        return cls(reader, writer)
+
+    async def send_packet(self, packet_bytes):
+        """Send a binary blob."""
+        assert(packet_bytes)
+        self._writer.writelines([
+            len(packet_bytes).to_bytes(4, "little"),
+            packet_bytes])
+        await self._writer.drain()
+
+    async def recv_packet(self):
+        """Get the next binary blob.
+
+        Returns None if the other end hung up (including in the middle
+        of a packet, which we just drop, same as PacketSocket).
+
+        """
+        try:
+            size_bytes = await self._reader.readexactly(4)
+            return await self._reader.readexactly(
+                int.from_bytes(size_bytes, "little"))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return None
+
+    def get_peer_address(self):
+        return self._writer.get_extra_info("peername")
+
+    async def close(self):
+        """Disconnect."""
+        self._writer.close()
+        try:
+            await self._writer.wait_closed()
+        except ConnectionError:
+            pass
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        packet = await self.recv_packet()
+        if packet is None:
+            raise StopAsyncIteration
+        return packet
+
+async def start_server(address, connection_callback):
+    """Start a listening server (like PacketSocket.start_server).
+
+    connection_callback gets called with an AsyncPacketSocket for every
+    new connection. If it's a coroutine function, it gets its own task,
+    so each connection can just loop on recv_packet(). The connection
+    is closed when it returns.
+
+    Address is a tuple with a host IP (string) and a port number
+    (int). Use "0.0.0.0" to open on every interface. Port 0 picks a
+    free one (see the returned asyncio.Server's sockets).
+
+    Returns the asyncio.Server. Use close() and wait_closed() on it to
+    shut down.
+
+    """
+
+    async def _handle_connection(reader, writer):
+        packet_socket = AsyncPacketSocket(reader, writer)
+        try:
+            ret = connection_callback(packet_socket)
+            if asyncio.iscoroutine(ret):
+                await ret
+        finally:
+            await packet_socket.close()
+
+    return await asyncio.start_server(
+        _handle_connection, address[0], address[1])
@@ -119,7 +119,9 @@ try:
             packet_socket.stop()
             raise Exception("Disconnected from RPC host.")
 
-        next_packet = packet_socket.get_next_packet()
+        # Sleep until something comes in (or we get disconnected, which
+        # we'll catch at the top of the loop).
+        next_packet = packet_socket.wait_for_packet()
         while next_packet:
             this_packet = next_packet
             next_packet = packet_socket.get_next_packet()
@@ -162,8 +164,6 @@ try:
 
             send_response(ret, request_id)
 
-        time.sleep(0.0001)
-
 except Exception as e:
 
     # FIXME: Do we need the extra exception handler inside the